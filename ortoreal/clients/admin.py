@@ -242,6 +242,7 @@ class JobAdmin(admin.ModelAdmin):
         StatusInline,
     ]
     list_display = ("client", "prosthesis", "prosthetist", "date", "status")
+    list_select_related = ("client", "prosthesis", "prosthetist")
 
     def status(self, obj):
         return str(obj.status_display)
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.7 on 2026-10-16 20:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clients', '0057_alter_client_address'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='client',
+            name='debt',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=11, null=True, verbose_name='Долги, руб.'),
+        ),
+        migrations.AddField(
+            model_name='client',
+            name='notes',
+            field=models.CharField(blank=True, null=True, verbose_name='примечания'),
+        ),
+        migrations.AlterField(
+            model_name='client',
+            name='phone',
+            field=models.CharField(blank=True, null=True, verbose_name='телефон'),
+        ),
+    ]
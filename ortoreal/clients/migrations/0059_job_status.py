@@ -0,0 +1,72 @@
+# Generated by Django 4.2.7 on 2026-10-16 21:00
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def fill_job_status(apps, schema_editor):
+    """
+    Записать в работы их последние статусы.
+    """
+    Job = apps.get_model("clients", "Job")
+    Status = apps.get_model("clients", "Status")
+    latest = Status.objects.filter(job=OuterRef("pk")).order_by("-date", "-id")
+    Job.objects.update(
+        status_name=Subquery(latest.values("name")[:1]),
+        status_date=Subquery(latest.values("date")[:1]),
+        status_color=Subquery(latest.values("color")[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("clients", "0058_client_debt_client_notes_alter_client_phone"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="job",
+            name="status_color",
+            field=models.CharField(
+                blank=True,
+                choices=[
+                    ("in work", "B6D7A8"),
+                    ("issued", "6AA84F"),
+                    ("docs submitted", "34A853"),
+                    ("payment to client", "00FFFF"),
+                    ("payment", "6D9EEB"),
+                ],
+                editable=False,
+                max_length=150,
+                null=True,
+                verbose_name="цвет статуса",
+            ),
+        ),
+        migrations.AddField(
+            model_name="job",
+            name="status_date",
+            field=models.DateTimeField(
+                editable=False, null=True, verbose_name="дата статуса"
+            ),
+        ),
+        migrations.AddField(
+            model_name="job",
+            name="status_name",
+            field=models.CharField(
+                blank=True,
+                choices=[
+                    ("in work", "принят в работу"),
+                    ("issued", "выдан"),
+                    ("docs submitted", "документы сданы"),
+                    ("payment to client", "оплата клиенту"),
+                    ("payment", "оплата"),
+                ],
+                editable=False,
+                max_length=150,
+                null=True,
+                verbose_name="статус",
+            ),
+        ),
+        migrations.RunPython(fill_job_status, migrations.RunPython.noop),
+    ]
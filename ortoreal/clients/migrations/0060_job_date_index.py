@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-16 21:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("clients", "0059_job_status"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="job",
+            index=models.Index(fields=["date", "id"], name="job_date_id_idx"),
+        ),
+    ]
@@ -3,7 +3,7 @@ from tabnanny import verbose
 from typing import Iterable, Optional
 
 from django.contrib.auth import get_user_model
-from django.db import IntegrityError, models
+from django.db import IntegrityError, models, transaction
 from django.db.models import CharField, Value
 from django.db.models.functions import Cast, Concat, Substr
 from django.urls import reverse
@@ -69,7 +69,15 @@ class Status(models.Model):
 
     def save(self, *args, **kwargs):
         self.color = self.name
-        super().save(*args, **kwargs)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            self.job.update_status()
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            result = super().delete(*args, **kwargs)
+            self.job.update_status()
+        return result
 
     def get_absolute_url(self):
         return reverse(
@@ -350,15 +358,37 @@ class Job(models.Model):
     )
     date = models.DateTimeField(_("date"), default=timezone.now)
     is_finished = models.BooleanField("завершена", default=False)
+    # последний статус, записывается при изменении статусов работы
+    status_name = models.CharField(
+        "статус",
+        max_length=150,
+        choices=Status.StatusNames.choices,
+        blank=True,
+        null=True,
+        editable=False,
+    )
+    status_date = models.DateTimeField("дата статуса", null=True, editable=False)
+    status_color = models.CharField(
+        "цвет статуса",
+        max_length=150,
+        choices=Status.StatusColors.choices,
+        blank=True,
+        null=True,
+        editable=False,
+    )
+
+    # поля последнего статуса ведёт Status
+    STATUS_FIELDS = ("status_name", "status_date", "status_color")
 
     @property
     def status_display(self):
-        if self.statuses.exists():
-            return str(self.statuses.latest("date"))
-            # date = date_format(
-            # status.date, format="SHORT_DATE_FORMAT", use_l10n=True
-            # )
-            # return f"{status.name} {date}"
+        if self.status_name:
+            date = date_format(
+                timezone.localdate(self.status_date),
+                format="SHORT_DATE_FORMAT",
+                use_l10n=True,
+            )
+            return f"{self.get_status_name_display()} {date}"
         return "—нет статуса—"
 
     status_display.fget.short_description = "статус"
@@ -366,6 +396,10 @@ class Job(models.Model):
     class Meta:
         verbose_name = "работа"
         verbose_name_plural = "работы"
+        indexes = [
+            # keyset-пагинация комплектов
+            models.Index(fields=["date", "id"], name="job_date_id_idx"),
+        ]
 
     def __str__(self) -> str:
         client_name = self.client.get_name_with_initials()
@@ -377,9 +411,28 @@ class Job(models.Model):
         """
         if self.prosthesis and self.client.region != self.prosthesis.region:
             raise IntegrityError("регион клиента и протеза должны быть равны")
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            # не перезаписываем последний статус устаревшими значениями
+            kwargs["update_fields"] = [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.STATUS_FIELDS
+            ]
         super().save(*args, **kwargs)
-        if not self.statuses.exists():
+        if self.status_name is None and not self.statuses.exists():
             Status.objects.create(job=self)
 
+    def update_status(self):
+        """
+        Записать в работу её последний статус.
+        """
+        status = self.statuses.order_by("-date", "-id").first()
+        self.status_name = status.name if status else None
+        self.status_date = status.date if status else None
+        self.status_color = status.color if status else None
+        Job.objects.filter(pk=self.pk).update(
+            **{field: getattr(self, field) for field in self.STATUS_FIELDS}
+        )
+
     def get_absolute_url(self):
         return reverse("clients:job", kwargs={"pk": self.pk})
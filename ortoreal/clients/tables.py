@@ -1,8 +1,11 @@
+import itertools
+
 from django.conf import settings
 from django.db import models
-from django.db.models import Case, F, Q, Value, When
+from django.db.models import Case, F, Prefetch, Q, Value, When
 from django.db.models.functions import Concat
 from django.urls import reverse
+from django.utils.dateparse import parse_datetime
 from django.utils.html import conditional_escape, format_html, mark_safe
 
 import django_tables2 as tables
@@ -121,10 +124,27 @@ from inventory.utils import dec2pre, get_dec_display, wrap_in_color
 
 # @library.register
 class ItemsColumn(tables.ManyToManyColumn):
+    """
+    Комплектующие работы. Одинаковые единицы выводятся одной
+    плашкой «артикул (статус) ×N».
+
+    Модели и заказы единиц берутся из get_prefetch(), без запросов
+    на каждую единицу.
+    """
+
     def __init__(self, per_line=10, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.per_line = per_line
 
+    @staticmethod
+    def get_prefetch(lookup="reserved_items"):
+        return Prefetch(
+            lookup,
+            queryset=Item.objects.select_related("part", "order").order_by(
+                "part__vendor_code", "id"
+            ),
+        )
+
     def transform(self, obj):
         status = self.get_status(obj)
         color = self.get_color(obj)
@@ -134,7 +154,7 @@ class ItemsColumn(tables.ManyToManyColumn):
 
     def get_color(self, item):
         if item.arrived:
-            if item.job is None:
+            if item.job_id is None:
                 return "green"
             return "darkgreen"
         if item.order and item.order.is_current:
@@ -144,7 +164,7 @@ class ItemsColumn(tables.ManyToManyColumn):
     def get_status(self, item):
         status = "(3)"
         if item.arrived:
-            if item.job is None:
+            if item.job_id is None:
                 status = "(C)"
             else:
                 status = "(П)"
@@ -153,20 +173,20 @@ class ItemsColumn(tables.ManyToManyColumn):
         return item.part.vendor_code + " " + status
 
     def render(self, value):
-        items = []
-        filtered_items = self.filter(value)
-        for i, item in enumerate(filtered_items):
-            content = self.transform(item)
-            if hasattr(self, "linkify_item"):
-                content = self.linkify_item(content=content, record=item)
-
-            items.append(content)
-            if ((len(items) + 1) % (self.per_line + 1) == 0) and (
-                i < (len(filtered_items) + 1)
-            ):
-                items.append(self.separator)
-
-        return mark_safe(" ".join(items))
+        items = sorted(self.filter(value), key=self.get_status)
+        pills = []
+        for _, group in itertools.groupby(items, key=self.get_status):
+            group = list(group)
+            content = self.transform(group[0])
+            if len(group) > 1:
+                content = f"{content} ×{len(group)}"
+            pills.append(self.linkify_item(content=content, record=group[0]))
+
+        lines = [
+            " ".join(pills[i : i + self.per_line])
+            for i in range(0, len(pills), self.per_line)
+        ]
+        return mark_safe(f" {self.separator} ".join(lines))
 
 
 class ClientProsthesisListTable(tables.Table):
@@ -178,8 +198,7 @@ class ClientProsthesisListTable(tables.Table):
     region = tables.Column("Регион", accessor="prosthesis.region")
 
     def render_status(self, record, column):
-        status = record.statuses.latest("date")
-        status_name = "-".join(status.name.split())
+        status_name = "-".join((record.status_name or "").split())
         column.attrs = {"td": {"class": status_name}}
         job_url = reverse("clients:change_job_status", kwargs={"pk": record.pk})
         button = f'<a class="btn btn-secondary" href="{job_url}">Изменить</a>'
@@ -196,7 +215,7 @@ class ClientProsthesisListTable(tables.Table):
             "date",
             "reserved_items",
         ]
-        exclude = ["id", "client", "is_finished"]
+        exclude = ["id", "client", "is_finished", *Job.STATUS_FIELDS]
         row_attrs = {
             # "data-href": lambda record: reverse(
             #     "inventory:job_set", kwargs={"pk": record.pk}
@@ -265,8 +284,10 @@ class ClientsTable(tables.Table):
     jobs_count = tables.Column("Всего работ", accessor="jobs_count")
     jobs_in_progress = tables.Column("Активные", accessor="jobs_in_progress")
     statuses = tables.Column("Статусы активных работ", empty_values=())
-    passport = tables.Column("Паспорт", empty_values=(), accessor="passport")
-    bank_details = tables.Column("Реквизиты", empty_values=(), accessor="bank_details")
+    passport = tables.Column("Паспорт", empty_values=(), accessor="has_passport")
+    bank_details = tables.Column(
+        "Реквизиты", empty_values=(), accessor="has_bank_details"
+    )
     snils = tables.Column(empty_values=())
     snils_scan = ClientsBooleanColumn
     ipr = ClientsBooleanColumn
@@ -292,15 +313,21 @@ class ClientsTable(tables.Table):
         return self.get_yesno(value)
 
     def render_statuses(self, record, column):
-        jobs = record.jobs.filter(is_finished=False).order_by("-date")
+        # активные работы собраны в ClientsListView.get_queryset
         statuses_display = []
-        for job in jobs:
-            status = job.statuses.latest("date")
-            job_name = job.prosthesis or "протез не выбран"
-            status_name = "-".join(status.name.split())
-            status_display = (
-                f'<span class="{status_name} status-pill">'
-                f"{job_name} - {status}</span>"
+        for job in record.active_jobs or ():
+            status_date = job["status_date"]
+            status = Job(
+                status_name=job["status_name"],
+                status_date=status_date and parse_datetime(status_date),
+            ).status_display
+            job_name = job["prosthesis"] or "протез не выбран"
+            status_name = "-".join((job["status_name"] or "").split())
+            status_display = format_html(
+                '<span class="{} status-pill">{} - {}</span>',
+                status_name,
+                job_name,
+                status,
             )
             statuses_display.append(status_display)
         output = "<br>".join(statuses_display)
@@ -4,11 +4,11 @@ from typing import Any, Dict, Optional
 from django import forms
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
+from django.contrib.postgres.aggregates import ArrayAgg
 from django.core import serializers
-from django.core.paginator import Paginator
 from django.db import transaction
-from django.db.models import Case, Count, F, Max, Q, Value, When
-from django.db.models.functions import Concat
+from django.db.models import Case, Count, Exists, F, Max, OuterRef, Q, Value, When
+from django.db.models.functions import Concat, JSONObject
 from django.db.models.query import QuerySet
 from django.shortcuts import get_object_or_404, redirect, render
 from django.views import View
@@ -24,13 +24,23 @@ from clients.forms import (
     JobForm,
     JobStatusSelectForm,
 )
-from clients.models import Client, Comment, Contact, Job, Status
+from clients.models import (
+    BankDetails,
+    Client,
+    Comment,
+    Contact,
+    Job,
+    Passport,
+    Status,
+)
 from clients.tables import (
     ClientProsthesisListTable,
     ClientsTable,
+    ItemsColumn,
     JobItemsTable,
     JobStatusesTable,
 )
+from core.paginators import CURSOR_PARAM, KeysetPaginator
 from inventory.models import Item
 from inventory.tables import ClientItemsTable
 
@@ -44,9 +54,8 @@ CLIENTS_PER_PAGE = 20
 def contacts(request):
     table_head = ["ID", "ФИО"] + Contact.get_field_names()[4:]
     contact_list = Contact.objects.order_by("id")
-    paginator = Paginator(contact_list, 20)
-    page_number = request.GET.get("page")
-    page_obj = paginator.get_page(page_number)
+    paginator = KeysetPaginator(contact_list, 20, cursor=request.GET.get(CURSOR_PARAM))
+    page_obj = paginator.page()
     context = {
         "table_head": table_head,
         "page_obj": page_obj,
@@ -193,8 +202,20 @@ class ClientsListView(LoginRequiredMixin, UserPassesTestMixin, tables.SingleTabl
             jobs_count=Count("jobs"),
             jobs_in_progress=Count("jobs", filter=Q(jobs__is_finished=False)),
             latest_job_date=Max("jobs__date"),
+            # последние статусы активных работ, см. ClientsTable.render_statuses
+            active_jobs=ArrayAgg(
+                JSONObject(
+                    prosthesis="jobs__prosthesis__number",
+                    status_name="jobs__status_name",
+                    status_date="jobs__status_date",
+                ),
+                filter=Q(jobs__is_finished=False),
+                ordering="-jobs__date",
+                default=None,
+            ),
+            has_passport=Exists(Passport.objects.filter(client=OuterRef("pk"))),
+            has_bank_details=Exists(BankDetails.objects.filter(client=OuterRef("pk"))),
         ).order_by("-latest_job_date")
-        print(qs.values("latest_job_date"))
         return qs
 
     def get_context_data(self, **kwargs: Any) -> Dict[str, Any]:
@@ -236,7 +257,12 @@ class ClientView(LoginRequiredMixin, UserPassesTestMixin, View):
         return render(request, "clients/client.html", context)
 
     def get_queryset(self):
-        queryset = Job.objects.filter(client=self.get_client()).order_by("-date")
+        queryset = (
+            Job.objects.filter(client=self.get_client())
+            .select_related("prosthetist", "prosthesis")
+            .prefetch_related(ItemsColumn.get_prefetch())
+            .order_by("-date")
+        )
         return queryset
 
 
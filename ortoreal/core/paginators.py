@@ -0,0 +1,236 @@
+import datetime
+import decimal
+import json
+import operator
+import uuid
+from collections.abc import Sequence
+from functools import reduce
+
+from django.core import signing
+from django.db.models import F, OrderBy, Q
+
+from django_tables2.rows import BoundRows
+
+CURSOR_PARAM = "cursor"
+CURSOR_SALT = "core.paginators.keyset"
+
+
+class CursorEncoder(json.JSONEncoder):
+    """
+    JSON для значений курсора. Даты пишутся полностью, с микросекундами,
+    иначе сравнение с границей страницы будет неточным.
+    """
+
+    def default(self, o):
+        if isinstance(o, (datetime.date, datetime.time)):
+            return o.isoformat()
+        if isinstance(o, (decimal.Decimal, uuid.UUID)):
+            return str(o)
+        return super().default(o)
+
+
+class CursorSerializer:
+    def dumps(self, obj):
+        return json.dumps(obj, cls=CursorEncoder, separators=(",", ":")).encode()
+
+    def loads(self, data):
+        return json.loads(data.decode())
+
+
+class KeysetPage(Sequence):
+    """
+    Страница keyset-пагинации. Вместо номеров соседних страниц
+    знает курсоры на них.
+    """
+
+    def __init__(self, object_list, paginator, previous_cursor, next_cursor):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.previous_cursor = previous_cursor
+        self.next_cursor = next_cursor
+
+    def __repr__(self):
+        return f"<Keyset page of {len(self.object_list)}>"
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_previous() or self.has_next()
+
+
+class KeysetPaginator:
+    """
+    Пагинация по ключу сортировки (keyset).
+
+    Страница выбирается условием по значениям ключа на границе
+    предыдущей страницы и LIMIT, без OFFSET и COUNT, поэтому дальние
+    страницы стоят столько же, сколько первая. Ключ берётся из сортировки
+    queryset, к нему добавляется pk. Курсор передаётся в GET-параметре
+    cursor, номера страниц не поддерживаются.
+
+    Принимает queryset или строки таблицы django-tables2.
+    """
+
+    keyset = True
+
+    def __init__(self, object_list, per_page, cursor=None, **kwargs):
+        self.object_list = object_list
+        self.per_page = int(per_page)
+        self.cursor = cursor
+
+    def get_queryset(self):
+        # django-tables2 передаёт BoundRows -> TableQuerysetData -> QuerySet
+        data = getattr(self.object_list, "data", self.object_list)
+        return getattr(data, "data", data)
+
+    @staticmethod
+    def get_ordering(queryset):
+        query = queryset.query
+        ordering = query.order_by
+        if not ordering and query.default_ordering:
+            ordering = query.get_meta().ordering
+        keys = []
+        for field in ordering:
+            if isinstance(field, OrderBy) and isinstance(field.expression, F):
+                field = ("-" if field.descending else "") + field.expression.name
+            if not isinstance(field, str) or field == "?":
+                raise ValueError(f"keyset-пагинация не поддерживает сортировку {field}")
+            keys.append(field)
+        if not {"pk", "-pk", "id", "-id"} & set(keys):
+            descending = bool(keys) and keys[-1].startswith("-")
+            keys.append("-pk" if descending else "pk")
+        return keys
+
+    def dump_cursor(self, direction, keys, record, aliases):
+        values = [getattr(record, alias) for alias in aliases]
+        return signing.dumps(
+            [direction, keys, values],
+            salt=CURSOR_SALT,
+            serializer=CursorSerializer,
+            compress=True,
+        )
+
+    def load_cursor(self, keys):
+        """
+        Направление и значения ключа из курсора. Курсор другой сортировки
+        (например, после смены сортировки таблицы) ведёт на первую страницу.
+        """
+        if not self.cursor:
+            return None, None
+        try:
+            direction, cursor_keys, values = signing.loads(
+                self.cursor, salt=CURSOR_SALT, serializer=CursorSerializer
+            )
+        except (signing.BadSignature, ValueError, TypeError):
+            return None, None
+        if cursor_keys != keys or len(values) != len(keys):
+            return None, None
+        return direction, values
+
+    @staticmethod
+    def get_after(alias, descending, value, nullable):
+        """
+        Условие «строка дальше значения» с учётом NULL, которые
+        Postgres сортирует как значения больше любых других.
+        """
+        if descending:
+            if value is None:
+                return Q(**{f"{alias}__isnull": False})
+            return Q(**{f"{alias}__lt": value})
+        if value is None:
+            return None
+        condition = Q(**{f"{alias}__gt": value})
+        if nullable:
+            condition |= Q(**{f"{alias}__isnull": True})
+        return condition
+
+    def get_condition(self, queryset, aliases, descending, values):
+        conditions = []
+        equal = Q()
+        for alias, desc, value in zip(aliases, descending, values):
+            output_field = queryset.query.annotations[alias].output_field
+            nullable = getattr(output_field, "null", True)
+            after = self.get_after(alias, desc, value, nullable)
+            if after is not None:
+                conditions.append(equal & after)
+            if value is None:
+                equal &= Q(**{f"{alias}__isnull": True})
+            else:
+                equal &= Q(**{alias: value})
+        if not conditions:
+            return Q(pk__in=[])
+        return reduce(operator.or_, conditions)
+
+    def page(self, number=None):
+        queryset = self.get_queryset()
+        keys = self.get_ordering(queryset)
+        aliases = [f"keyset_{i}" for i in range(len(keys))]
+        descending = [key.startswith("-") for key in keys]
+        queryset = queryset.annotate(
+            **{alias: F(key.lstrip("-")) for alias, key in zip(aliases, keys)}
+        )
+
+        direction, values = self.load_cursor(keys)
+        backwards = direction == "previous"
+        if backwards:
+            descending = [not desc for desc in descending]
+        queryset = queryset.order_by(
+            *[("-" if desc else "") + alias for alias, desc in zip(aliases, descending)]
+        )
+        if values is not None:
+            queryset = queryset.filter(
+                self.get_condition(queryset, aliases, descending, values)
+            )
+
+        records = list(queryset[: self.per_page + 1])
+        has_more = len(records) > self.per_page
+        records = records[: self.per_page]
+        if backwards:
+            records.reverse()
+            has_previous, has_next = has_more, True
+        else:
+            has_previous, has_next = values is not None, has_more
+
+        previous_cursor = next_cursor = None
+        if records and has_previous:
+            previous_cursor = self.dump_cursor("previous", keys, records[0], aliases)
+        if records and has_next:
+            next_cursor = self.dump_cursor("next", keys, records[-1], aliases)
+
+        object_list = records
+        if isinstance(self.object_list, BoundRows):
+            object_list = BoundRows(records, self.object_list.table)
+        return KeysetPage(object_list, self, previous_cursor, next_cursor)
+
+    def get_page(self, number=None):
+        return self.page(number)
+
+
+class KeysetPaginationMixin:
+    """
+    Keyset-пагинация для представлений django-tables2.
+    """
+
+    paginator_class = KeysetPaginator
+    table_template_name = "django_tables2/bootstrap5-keyset.html"
+
+    def get_table_kwargs(self):
+        kwargs = super().get_table_kwargs()
+        kwargs.setdefault("template_name", self.table_template_name)
+        return kwargs
+
+    def get_table_pagination(self, table):
+        paginate = super().get_table_pagination(table)
+        if paginate:
+            paginate["cursor"] = self.request.GET.get(CURSOR_PARAM)
+        return paginate
@@ -1,4 +1,5 @@
 from django.contrib import admin
+from django.db import transaction
 from django.db.models import Sum
 
 from inventory.models import (
@@ -10,7 +11,7 @@ from inventory.models import (
     Prosthesis,
     Vendor,
 )
-from inventory.utils import dec2pre
+from inventory.utils import dec2pre, lock_parts, update_part_stock
 
 
 @admin.register(Order)
@@ -48,6 +49,7 @@ class PartAdmin(admin.ModelAdmin):
         "note",
     )
     list_display_links = list_display
+    list_select_related = ("stock",)
     search_fields = ("vendor_code", "name")
 
 
@@ -56,22 +58,17 @@ class InventoryLogAdmin(admin.ModelAdmin):
     list_display = (
         "id",
         "operation",
-        # "vendor_code",
-        # "part_name",
-        "quantity",
+        "vendor_code",
+        "part_name",
+        "item_count",
         "prosthetist",
         "date",
         "comment",
     )
-    # list_display_links = ("id", "operation", "vendor_code", "part_name")
-    search_fields = ("items__part__vendor_code", "items__part__name")
-
-    # исправить позже
-    # autocomplete_fields = ("part",)
-    def quantity(self, obj):
-        return obj.items.count()
-
-    quantity.short_description = "кол-во"
+    list_display_links = ("id", "operation", "vendor_code", "part_name")
+    list_select_related = ("prosthetist",)
+    search_fields = ("vendor_code", "part_name")
+    autocomplete_fields = ("part",)
 
 
 @admin.register(Item)
@@ -91,6 +88,26 @@ class ItemAdmin(admin.ModelAdmin):
     search_fields = ("part__vendor_code", "part__name")
     autocomplete_fields = ("part",)
 
+    def save_model(self, request, obj, form, change):
+        parts = {obj.part_id}
+        if change and "part" in form.changed_data:
+            parts.add(form.initial["part"])
+        lock_parts(parts)
+        super().save_model(request, obj, form, change)
+        update_part_stock(parts)
+
+    def delete_model(self, request, obj):
+        lock_parts([obj.part_id])
+        super().delete_model(request, obj)
+        update_part_stock([obj.part_id])
+
+    @transaction.atomic
+    def delete_queryset(self, request, queryset):
+        parts = set(queryset.values_list("part_id", flat=True).order_by())
+        lock_parts(parts)
+        super().delete_queryset(request, queryset)
+        update_part_stock(parts)
+
     def vendor_code(self, obj):
         return obj.part.vendor_code
 
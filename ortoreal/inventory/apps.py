@@ -6,3 +6,6 @@ class InventoryConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "inventory"
     verbose_name = _("Склад")
+
+    def ready(self):
+        from inventory import signals  # noqa: F401
@@ -11,7 +11,6 @@ from bootstrap_datepicker_plus.widgets import (
     DateTimePickerInput,
 )
 from django_filters import FilterSet, widgets
-from django_select2 import forms as s2forms
 
 from clients.models import Job
 from inventory.forms import DatePicker
@@ -36,13 +35,6 @@ def get_first_log_date():
     return timezone.localtime(date).strftime("%Y-%m-%d %H:%M")
 
 
-class JobWidget(s2forms.ModelSelect2Widget):
-    search_fields = [
-        "client__first_name__icontains",
-        "client__last_name__icontains",
-    ]
-
-
 class InventoryLogFilter(FilterSet):
     job = filters.CharFilter(
         label="Работа",
@@ -1,10 +1,16 @@
 from decimal import Decimal
 
 from django import forms
+from django.core.validators import FileExtensionValidator
+from django.db.models import Model
 from django.utils import timezone
+from django.utils.functional import cached_property
+
+from django_select2 import forms as s2forms
 
 from clients.models import Client, Job
 from inventory.models import InventoryLog, Invoice, Item, Order, Part, Prosthesis
+from inventory.utils import ReceptionRow
 
 
 class DatePicker(forms.DateInput):
@@ -19,6 +25,102 @@ class DateTimePicker(forms.DateInput):
     input_type = "datetime-local"
 
 
+class JobWidget(s2forms.ModelSelect2Widget):
+    """
+    Выбор работы с поиском по фамилии клиента.
+    """
+
+    search_fields = ["client__last_name__istartswith"]
+    theme = "bootstrap-5"
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("data_view", "inventory:job_autocomplete")
+        super().__init__(*args, **kwargs)
+
+
+class PartWidget(s2forms.ModelSelect2Widget):
+    """
+    Выбор модели комплектующего с поиском по артикулу и названию.
+
+    Значения полей из data_fields отдаются вместе с результатами поиска
+    и в data-атрибутах выбранной опции.
+    """
+
+    search_fields = ["vendor_code__istartswith", "name__istartswith"]
+    data_fields = ()
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("data_view", "inventory:part_autocomplete")
+        super().__init__(*args, **kwargs)
+
+    def get_data(self, obj):
+        return {field: getattr(obj, field) for field in self.data_fields}
+
+    def create_option(self, name, value, *args, **kwargs):
+        option = super().create_option(name, value, *args, **kwargs)
+        instance = getattr(value, "instance", None)
+        if instance is not None:
+            for field, data in self.get_data(instance).items():
+                option["attrs"][f"data-{field}"] = data
+        return option
+
+    def optgroups(self, name, value, attrs=None):
+        """
+        Выбранные опции из моделей, загруженных формсетом, без запроса.
+        """
+        field = getattr(self.choices, "field", None)
+        instances = getattr(field, "instances", None)
+        if instances is None:
+            return super().optgroups(name, value, attrs=attrs)
+        options = []
+        if not self.is_required:
+            options.append(self.create_option(name, "", "", False, 0))
+        for pk in value:
+            obj = instances.get(field.get_key(pk))
+            if obj is not None:
+                option_value = self.choices.choice(obj)[0]
+                label = self.label_from_instance(obj)
+                options.append(
+                    self.create_option(name, option_value, label, True, len(options))
+                )
+        return [(None, options, 0)]
+
+
+class AvailablePartWidget(PartWidget):
+    data_fields = ("available",)
+
+
+class RemainderPartWidget(PartWidget):
+    data_fields = ("minimum_remainder",)
+
+
+class PartChoiceField(forms.ModelChoiceField):
+    """
+    Выбор модели комплектующего.
+
+    Если формсет передал в instances загруженные модели, выбранное
+    значение берётся оттуда, а не отдельным запросом.
+    """
+
+    instances = None
+
+    @staticmethod
+    def get_key(value):
+        if isinstance(value, Model):
+            return value.pk
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+
+    def to_python(self, value):
+        if self.instances is not None and value not in self.empty_values:
+            obj = self.instances.get(self.get_key(value))
+            if obj is not None:
+                return obj
+        return super().to_python(value)
+
+
 class InventoryLogFormMeta:
     """
     Мета формы записи в логе
@@ -49,9 +151,9 @@ class InventoryTakeForm(forms.ModelForm):
     """
 
     job = forms.ModelChoiceField(
-        queryset=Job.objects.order_by("-client"),
+        queryset=Job.objects.select_related("client", "prosthesis").order_by("-client"),
         label="Клиент",
-        widget=forms.Select(
+        widget=JobWidget(
             attrs={
                 "onchange": "clearFormSet(); this.form.submit();",
             }
@@ -95,6 +197,13 @@ class ItemForm(forms.ModelForm):
             self.fields["price"].widget.attrs["class"] = "text-end"
         self.fields["quantity"].widget.attrs["class"] = "text-center"
 
+    def _get_validation_exclusions(self):
+        # модель уже выбрана из queryset поля, повторная проверка
+        # внешнего ключа стоила бы запроса на каждую форму
+        exclusions = super()._get_validation_exclusions()
+        exclusions.add("part")
+        return exclusions
+
 
 class ReceptionItemForm(ItemForm):
     """
@@ -118,11 +227,57 @@ class ReceptionItemForm(ItemForm):
     class Meta:
         model = Item
         fields = ("part", "quantity", "price", "vendor2")
+        field_classes = {"part": PartChoiceField}
+        widgets = {"part": PartWidget}
+
+
+class BasePartFormSet(forms.BaseFormSet):
+    """
+    Формсет с выбором моделей комплектующих.
+
+    Модели, выбранные во всех формах, загружаются одним запросом
+    и общие для всех форм.
+    """
+
+    @cached_property
+    def forms(self):
+        forms = super().forms
+        if forms:
+            instances = self.get_part_instances(forms)
+            for form in forms:
+                form.fields["part"].instances = instances
+        return forms
+
+    def get_part_instances(self, forms):
+        field = forms[0].fields["part"]
+        pks = {field.get_key(form["part"].value()) for form in forms}
+        pks.discard(None)
+        if not pks:
+            return {}
+        return field.queryset.in_bulk(pks)
+
+
+class BaseReceptionItemFormSet(BasePartFormSet):
+    def get_rows(self):
+        """
+        Строки прихода с указанным кол-вом.
+        """
+        rows = []
+        for form in self.forms:
+            data = form.cleaned_data
+            if data.get("part") and data.get("quantity"):
+                rows.append(
+                    ReceptionRow(
+                        data["part"], data["quantity"], data["price"], data["vendor2"]
+                    )
+                )
+        return rows
 
 
 # Формсет прихода комплектующих
 ReceptionItemFormSet = forms.formset_factory(
     ReceptionItemForm,
+    formset=BaseReceptionItemFormSet,
     extra=1,
 )
 
@@ -132,22 +287,18 @@ class ItemTakeForm(ItemForm):
     Форма расхода комплектующего.
     """
 
-    available = forms.ChoiceField(
+    # заполняется на странице из data-атрибутов выбранной модели
+    available = forms.IntegerField(
         label="Наличие",
-        choices=(),
         required=False,
-        initial="-",
-        widget=forms.Select(attrs={"hidden": ""}),
+        widget=forms.NumberInput(attrs={"hidden": ""}),
     )
 
     def __init__(self, *args, queryset=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.queryset = queryset
-        if queryset:
+        if queryset is not None:
             self.fields["part"].queryset = queryset
-            self.fields["available"].choices = [(0, "-")] + list(
-                queryset.values_list("id", "available")
-            )
 
     def clean_quantity(self):
         quantity = self.cleaned_data.get("quantity")
@@ -163,10 +314,13 @@ class ItemTakeForm(ItemForm):
     class Meta:
         model = Item
         fields = ("part", "quantity", "available")
+        field_classes = {"part": PartChoiceField}
+        widgets = {"part": AvailablePartWidget}
 
 
 ItemTakeFormSet = forms.formset_factory(
     ItemTakeForm,
+    formset=BasePartFormSet,
     extra=1,
 )
 
@@ -189,9 +343,9 @@ class JobSelectForm(forms.Form):
     """
 
     job = forms.ModelChoiceField(
-        queryset=Job.objects.order_by("-client"),
+        queryset=Job.objects.select_related("client", "prosthesis").order_by("-client"),
         label="Клиент",
-        widget=forms.Select(
+        widget=JobWidget(
             attrs={
                 "onchange": "clearFormSet(); this.form.submit();",
             }
@@ -280,7 +434,9 @@ class PickPartForm(forms.Form):
     Форма выбора комплектующей в протез.
     """
 
-    part = forms.ModelChoiceField(queryset=Part.objects.all(), label="Артикул")
+    part = PartChoiceField(
+        queryset=Part.objects.all(), label="Артикул", widget=PartWidget
+    )
     quantity = forms.IntegerField(
         label="Количество",
         required=True,
@@ -296,7 +452,9 @@ class PickPartForm(forms.Form):
         self.fields["quantity"].widget.attrs["class"] = "text-center"
 
 
-PickPartsFormSet = forms.formset_factory(form=PickPartForm, extra=1)
+PickPartsFormSet = forms.formset_factory(
+    form=PickPartForm, formset=BasePartFormSet, extra=1
+)
 
 
 class PartAddForm(forms.ModelForm):
@@ -333,33 +491,24 @@ class FreeOrderForm(ItemForm):
     Форма свободного заказа.
     """
 
-    minimum_remainder = forms.ChoiceField(
+    # заполняется на странице из data-атрибутов выбранной модели
+    minimum_remainder = forms.IntegerField(
         label="Неснижаемый остаток",
-        choices=(),
         required=False,
-        initial="-",
-        widget=forms.Select(
-            attrs={
-                "disabled": "true",
-                "class": "text-center",
-                "style": "-webkit-appearance: none;",
-            }
-        ),
+        disabled=True,
+        widget=forms.NumberInput(attrs={"class": "text-center"}),
     )
 
-    def __init__(self, *args, queryset=None, **kwargs):
-        super().__init__(*args, **kwargs)
-        queryset = self.fields["part"].queryset
-        self.fields["minimum_remainder"].choices = [(0, "-")] + list(
-            queryset.values_list("id", "minimum_remainder")
-        )
-
     class Meta:
         model = Item
         fields = ("part", "quantity", "minimum_remainder")
+        field_classes = {"part": PartChoiceField}
+        widgets = {"part": RemainderPartWidget}
 
 
-FreeOrderFormSet = forms.formset_factory(FreeOrderForm, extra=1)
+FreeOrderFormSet = forms.formset_factory(
+    FreeOrderForm, formset=BasePartFormSet, extra=1
+)
 
 
 class ReceptionForm(forms.ModelForm):
@@ -388,6 +537,27 @@ class ReceptionForm(forms.ModelForm):
         fields = ["invoice", "comment", "date"]
 
 
+class InvoiceImportForm(forms.ModelForm):
+    """
+    Форма прихода по файлу счёта поставщика.
+    """
+
+    invoice = forms.ModelChoiceField(
+        queryset=Invoice.objects.filter(
+            order__is_current=False, items__arrived=False
+        ).distinct(),
+        label="Номер счёта",
+    )
+    file = forms.FileField(
+        label="Файл счёта",
+        help_text="CSV или XLSX с колонками: артикул, кол-во, цена.",
+        validators=[FileExtensionValidator(["csv", "xlsx"])],
+    )
+
+    class Meta(InventoryLogFormMeta):
+        fields = ["invoice", "file", "comment", "date"]
+
+
 class InvoiceNumberForm(forms.Form):
     part_id = forms.CharField(required=False)
     invoice_number = forms.CharField(max_length=100, required=False)
@@ -0,0 +1,46 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand, CommandParser
+from django.db import close_old_connections
+
+from inventory.utils import check_minimum_remainder
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """
+    Дозаказ комплектующих до неснижаемого остатка.
+    """
+
+    help = "Добавить в текущий заказ нехватки до неснижаемого остатка."
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--interval",
+            type=int,
+            default=0,
+            help="Повторять проверку каждые N секунд",
+        )
+
+    def handle(self, *args, **options):
+        interval = options["interval"]
+        while True:
+            # соединение могло оборваться за время ожидания
+            close_old_connections()
+            try:
+                quantity = check_minimum_remainder()
+            except Exception:
+                # при повторах ошибка одной проверки не останавливает сервис
+                if not interval:
+                    raise
+                logger.exception("Ошибка проверки неснижаемого остатка")
+                self.stderr.write("Ошибка проверки неснижаемого остатка")
+            else:
+                self.stdout.write(
+                    self.style.SUCCESS(f"Добавлено в текущий заказ: {quantity}")
+                )
+            if not interval:
+                break
+            time.sleep(interval)
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+
+from inventory.models import Invoice
+from inventory.utils import import_invoice
+
+
+class Command(BaseCommand):
+    """
+    Приход по файлу счёта поставщика.
+    """
+
+    help = "Оприходовать комплектующие по файлу счёта (CSV или XLSX)."
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("file", type=str, help="Файл счёта")
+        parser.add_argument("invoice", type=str, help="Номер счёта")
+        parser.add_argument("--comment", type=str, default="", help="Комментарий")
+
+    def handle(self, *args, **options):
+        try:
+            invoice = Invoice.objects.get(number=options["invoice"])
+        except Invoice.DoesNotExist:
+            raise CommandError(f"Счёт {options['invoice']} не найден")
+
+        with open(options["file"], "rb") as file:
+            try:
+                logs = import_invoice(
+                    file, options["file"], invoice, comment=options["comment"]
+                )
+            except ValueError as e:
+                raise CommandError(e)
+
+        self.stdout.write(self.style.SUCCESS(f"Оприходовано строк: {len(logs)}"))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from inventory.models import Part
+from inventory.utils import lock_parts, update_part_stock
+
+
+class Command(BaseCommand):
+    """
+    Сверка сводки остатков с комплектующими.
+    """
+
+    help = "Пересчитать сводку остатков всех моделей комплектующих."
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        lock_parts(Part.objects.values_list("id", flat=True))
+        count = update_part_stock()
+        self.stdout.write(self.style.SUCCESS(f"Пересчитано моделей: {count}"))
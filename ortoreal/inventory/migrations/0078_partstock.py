@@ -0,0 +1,66 @@
+# Generated by Django 4.2.7 on 2026-10-16 20:44
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+import django.db.models.deletion
+
+
+def fill_part_stock(apps, schema_editor):
+    Item = apps.get_model("inventory", "Item")
+    Part = apps.get_model("inventory", "Part")
+    PartStock = apps.get_model("inventory", "PartStock")
+    counts = {
+        row["part_id"]: row
+        for row in Item.objects.filter(job=None)
+        .values("part_id")
+        .annotate(
+            on_hand_count=Count("id", filter=Q(arrived=True)),
+            available_count=Count("id", filter=Q(arrived=True, reserved=None)),
+            reserved_count=Count("id", filter=Q(arrived=True, reserved__isnull=False)),
+            on_order_count=Count("id", filter=Q(arrived=False, order__is_current=False)),
+            in_current_order_count=Count(
+                "id", filter=Q(arrived=False, order__is_current=True)
+            ),
+        )
+        .order_by()
+    }
+    stocks = []
+    for part_id in Part.objects.values_list("id", flat=True):
+        row = counts.get(part_id, {})
+        stocks.append(
+            PartStock(
+                part_id=part_id,
+                on_hand=row.get("on_hand_count", 0),
+                available=row.get("available_count", 0),
+                reserved=row.get("reserved_count", 0),
+                on_order=row.get("on_order_count", 0),
+                in_current_order=row.get("in_current_order_count", 0),
+            )
+        )
+    PartStock.objects.bulk_create(stocks, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0077_prosthesis_price_end_date_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PartStock',
+            fields=[
+                ('part', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stock', serialize=False, to='inventory.part', verbose_name='модель комплектующей')),
+                ('on_hand', models.PositiveIntegerField(default=0, verbose_name='на складе')),
+                ('available', models.PositiveIntegerField(default=0, verbose_name='доступно')),
+                ('reserved', models.PositiveIntegerField(default=0, verbose_name='в резерве')),
+                ('on_order', models.PositiveIntegerField(default=0, verbose_name='в заказах')),
+                ('in_current_order', models.PositiveIntegerField(default=0, verbose_name='в текущем заказе')),
+            ],
+            options={
+                'verbose_name': 'остаток',
+                'verbose_name_plural': 'остатки',
+            },
+        ),
+        migrations.RunPython(fill_part_stock, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 4.2.7 on 2026-10-16 20:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+import inventory.models
+
+
+def merge_current_orders(apps, schema_editor):
+    """
+    Оставить один текущий заказ: перенести в него комплектующие, счета и
+    записи журнала из остальных текущих заказов, а опустевшие удалить.
+    """
+    Order = apps.get_model("inventory", "Order")
+    Item = apps.get_model("inventory", "Item")
+    Invoice = apps.get_model("inventory", "Invoice")
+    InventoryLog = apps.get_model("inventory", "InventoryLog")
+    current = list(
+        Order.objects.filter(is_current=True).order_by("-id").values_list(
+            "id", flat=True
+        )
+    )
+    if len(current) < 2:
+        return
+    for model in (Item, Invoice, InventoryLog):
+        model.objects.filter(order_id__in=current[1:]).update(order_id=current[0])
+    Order.objects.filter(id__in=current[1:]).delete()
+    # Проверить отложенные внешние ключи сейчас: с ожидающими триггерами
+    # PostgreSQL не даст создать индекс ограничения в этой же транзакции.
+    schema_editor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0078_partstock'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='item',
+            name='order',
+            field=models.ForeignKey(blank=True, default=inventory.models.get_current_order_id, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='items', to='inventory.order', verbose_name='заказ'),
+        ),
+        migrations.RunPython(merge_current_orders, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='order',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_current', True)), fields=('is_current',), name='unique_current_order'),
+        ),
+    ]
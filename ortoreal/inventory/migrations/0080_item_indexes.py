@@ -0,0 +1,29 @@
+# Generated by Django 4.2.7 on 2026-10-16 20:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0079_current_order'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(condition=models.Q(('job', None)), fields=['part', 'reserved'], name='item_free_part_reserved_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(condition=models.Q(('arrived', True), ('job', None)), fields=['part'], name='item_on_hand_part_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(fields=['order', 'part'], name='item_order_part_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(condition=models.Q(('free_order', True)), fields=['order', 'part'], name='item_free_order_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-16 21:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("inventory", "0080_item_indexes"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="inventorylog",
+            index=models.Index(fields=["date", "id"], name="inventorylog_date_id_idx"),
+        ),
+    ]
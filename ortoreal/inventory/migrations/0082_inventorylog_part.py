@@ -0,0 +1,83 @@
+# Generated by Django 4.2.7 on 2026-10-16 21:13
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+import django.db.models.deletion
+import django.db.models.functions.text
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def fill_log_part(apps, schema_editor):
+    """
+    Записать в логи модель комплектующих и кол-во из их комплектующих.
+    """
+    InventoryLog = apps.get_model("inventory", "InventoryLog")
+    Part = apps.get_model("inventory", "Part")
+    LogItem = InventoryLog.items.through
+    log_items = LogItem.objects.filter(inventorylog=OuterRef("pk"))
+    item_count = (
+        log_items.order_by()
+        .values("inventorylog")
+        .annotate(count=Count("pk"))
+        .values("count")
+    )
+    InventoryLog.objects.update(
+        part=Subquery(log_items.order_by("pk").values("item__part")[:1]),
+        item_count=Coalesce(Subquery(item_count), Value(0)),
+    )
+    part = Part.objects.filter(pk=OuterRef("part"))
+    InventoryLog.objects.filter(part__isnull=False).update(
+        vendor_code=Subquery(part.values("vendor_code")[:1]),
+        part_name=Subquery(part.values("name")[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("inventory", "0081_inventorylog_date_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="inventorylog",
+            name="item_count",
+            field=models.PositiveIntegerField(default=0, verbose_name="количество"),
+        ),
+        migrations.AddField(
+            model_name="inventorylog",
+            name="part",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="logs",
+                to="inventory.part",
+                verbose_name="модель комплектующих",
+            ),
+        ),
+        migrations.AddField(
+            model_name="inventorylog",
+            name="part_name",
+            field=models.CharField(
+                blank=True, max_length=1024, verbose_name="наименование"
+            ),
+        ),
+        migrations.AddField(
+            model_name="inventorylog",
+            name="vendor_code",
+            field=models.CharField(blank=True, max_length=256, verbose_name="артикул"),
+        ),
+        migrations.AddIndex(
+            model_name="inventorylog",
+            index=models.Index(
+                django.contrib.postgres.indexes.OpClass(
+                    django.db.models.functions.text.Upper("vendor_code"),
+                    name="text_pattern_ops",
+                ),
+                name="inventorylog_vendor_code_idx",
+            ),
+        ),
+        migrations.RunPython(fill_log_part, migrations.RunPython.noop),
+    ]
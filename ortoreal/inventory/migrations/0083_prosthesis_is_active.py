@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-16 21:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0082_inventorylog_part'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='prosthesis',
+            name='is_active',
+            field=models.BooleanField(blank=True, default=True, null=True, verbose_name='активный'),
+        ),
+    ]
@@ -1,9 +1,14 @@
 import locale
+import logging
+import uuid
 from decimal import Decimal
 from typing import Iterable, Optional
 
 from django.contrib.auth import get_user_model
+from django.contrib.postgres.indexes import OpClass
+from django.core.cache import cache
 from django.db import models, transaction
+from django.db.models.functions import Upper
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
@@ -11,6 +16,8 @@ from django.utils.translation import gettext_lazy as _
 from clients.models import Job
 from core.utils import get_date_display
 
+logger = logging.getLogger(__name__)
+
 User = get_user_model()
 
 
@@ -48,9 +55,28 @@ class Order(models.Model):
         order, _ = cls.objects.get_or_create(is_current=True, defaults={"date": None})
         return order
 
+    @staticmethod
+    def clear_current_cache():
+        """
+        Сменить версию id текущего заказа во всех процессах.
+        """
+        global _current_order
+        _current_order = (None, None)
+        try:
+            cache.set(CURRENT_ORDER_VERSION_KEY, uuid.uuid4().hex, None)
+        except Exception:
+            logger.warning("Не удалось сменить версию текущего заказа", exc_info=True)
+
     class Meta:
         verbose_name = "заказ"
         verbose_name_plural = "заказы"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["is_current"],
+                condition=models.Q(is_current=True),
+                name="unique_current_order",
+            ),
+        ]
 
     def __str__(self) -> str:
         if self.is_current:
@@ -59,12 +85,20 @@ class Order(models.Model):
         return f"{self.vendor} ({date})"
 
     def save(self, *args, **kwargs):
-        if not self.is_current:
-            return super().save(*args, **kwargs)
-        with transaction.atomic():
-            Order.objects.filter(is_current=True).update(is_current=False)
+        adding = self._state.adding
+        if self.is_current:
             self.date = timezone.now()
+        with transaction.atomic():
+            # при создании прежний текущий заказ не снимается: второй
+            # текущий отклонит unique_current_order, а get_or_create
+            # в get_current перечитает существующий
+            if self.is_current and not adding:
+                Order.objects.filter(is_current=True).exclude(pk=self.pk).update(
+                    is_current=False
+                )
             super().save(*args, **kwargs)
+        if self.is_current or not adding:
+            transaction.on_commit(Order.clear_current_cache)
 
     def get_absolute_url(self):
         url = reverse("inventory:order_by_id", kwargs={"pk": self.pk})
@@ -73,6 +107,53 @@ class Order(models.Model):
         return url
 
 
+# id текущего заказа хранится в памяти процесса вместе с версией из общего
+# кэша, версия меняется при смене или удалении текущего заказа
+CURRENT_ORDER_VERSION_KEY = "current_order_version"
+
+# (версия, id текущего заказа)
+_current_order = (None, None)
+
+
+def get_current_order_version():
+    """
+    Действующая версия id текущего заказа из общего кэша.
+    """
+    version = cache.get(CURRENT_ORDER_VERSION_KEY)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(CURRENT_ORDER_VERSION_KEY, version, None):
+            version = cache.get(CURRENT_ORDER_VERSION_KEY, version)
+    return version
+
+
+def get_current_order_id():
+    """
+    Id текущего заказа: одно обращение к кэшу за версией, без запроса к базе.
+    Если кэш недоступен, id берётся из базы.
+    """
+    try:
+        version = get_current_order_version()
+    except Exception:
+        logger.warning(
+            "Кэш недоступен, id текущего заказа берётся из базы", exc_info=True
+        )
+        return Order.get_current().pk
+    cached_version, order_id = _current_order
+    if cached_version == version:
+        return order_id
+    order_id = Order.get_current().pk
+
+    def remember():
+        global _current_order
+        _current_order = (version, order_id)
+
+    # запоминается только закоммиченный заказ, id из отменённой
+    # транзакции в памяти не останется
+    transaction.on_commit(remember)
+    return order_id
+
+
 class Invoice(models.Model):
     number = models.CharField("номер", max_length=100, unique=True)
     order = models.ForeignKey(Order, verbose_name="заказ", on_delete=models.CASCADE)
@@ -119,7 +200,10 @@ class Part(models.Model):
         Кол-во комплектующих, которые
         пришли на склад, и не взяты в работу.
         """
-        total = self.items.filter(job=None, arrived=True).count()
+        try:
+            total = self.stock.on_hand
+        except PartStock.DoesNotExist:
+            total = 0
         return f"{total}"
 
     quantity_total.fget.short_description = "кол-во"
@@ -139,6 +223,35 @@ class Part(models.Model):
         return reverse("inventory:items", kwargs={"pk": self.pk})
 
 
+class PartStock(models.Model):
+    """
+    Сводка остатков по модели комплектующей.
+
+    Пересчитывается для затронутых моделей при каждой складской операции,
+    чтобы страницы склада не считали записи Item заново.
+    """
+
+    part = models.OneToOneField(
+        Part,
+        verbose_name="модель комплектующей",
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="stock",
+    )
+    on_hand = models.PositiveIntegerField("на складе", default=0)
+    available = models.PositiveIntegerField("доступно", default=0)
+    reserved = models.PositiveIntegerField("в резерве", default=0)
+    on_order = models.PositiveIntegerField("в заказах", default=0)
+    in_current_order = models.PositiveIntegerField("в текущем заказе", default=0)
+
+    class Meta:
+        verbose_name = "остаток"
+        verbose_name_plural = "остатки"
+
+    def __str__(self) -> str:
+        return f"{self.part.vendor_code} ({self.on_hand})"
+
+
 class Item(models.Model):
     """
     Модель комплектующей.
@@ -178,7 +291,7 @@ class Item(models.Model):
         blank=True,
         null=True,
         related_name="items",
-        default=Order.get_current,
+        default=get_current_order_id,
     )
     invoice = models.ForeignKey(
         Invoice,
@@ -212,6 +325,28 @@ class Item(models.Model):
     class Meta:
         verbose_name = "комплектующая"
         verbose_name_plural = "комплектующие"
+        indexes = [
+            # резервы и остатки: всё, что ещё не взято в работу
+            models.Index(
+                fields=["part", "reserved"],
+                condition=models.Q(job=None),
+                name="item_free_part_reserved_idx",
+            ),
+            # комплектующие на складе
+            models.Index(
+                fields=["part"],
+                condition=models.Q(job=None, arrived=True),
+                name="item_on_hand_part_idx",
+            ),
+            # содержимое заказов по моделям
+            models.Index(fields=["order", "part"], name="item_order_part_idx"),
+            # свободный заказ
+            models.Index(
+                fields=["order", "part"],
+                condition=models.Q(free_order=True),
+                name="item_free_order_idx",
+            ),
+        ]
 
     def __str__(self):
         return str(self.part.vendor_code)
@@ -326,13 +461,48 @@ class InventoryLog(models.Model):
     )
     date = models.DateTimeField("дата", default=timezone.now)
     comment = models.CharField("комментарий", max_length=1024, blank=True)
+    # модель комплектующих и кол-во на момент операции,
+    # чтобы журнал не собирать через комплектующие
+    part = models.ForeignKey(
+        Part,
+        verbose_name="модель комплектующих",
+        on_delete=models.SET_NULL,
+        related_name="logs",
+        blank=True,
+        null=True,
+    )
+    vendor_code = models.CharField("артикул", max_length=256, blank=True)
+    part_name = models.CharField("наименование", max_length=1024, blank=True)
+    item_count = models.PositiveIntegerField("количество", default=0)
 
     class Meta:
         verbose_name = "операция на складе"
         verbose_name_plural = "операции на складе"
+        indexes = [
+            # keyset-пагинация журнала
+            models.Index(fields=["date", "id"], name="inventorylog_date_id_idx"),
+            # фильтр журнала по началу артикула (istartswith)
+            models.Index(
+                OpClass(Upper("vendor_code"), name="text_pattern_ops"),
+                name="inventorylog_vendor_code_idx",
+            ),
+        ]
 
     def __str__(self):
         return f"{self.operation}"
 
+    @classmethod
+    def for_part(cls, part, item_count, **kwargs):
+        """
+        Запись лога операции с item_count комплектующих модели part.
+        """
+        return cls(
+            part=part,
+            vendor_code=part.vendor_code,
+            part_name=part.name,
+            item_count=item_count,
+            **kwargs,
+        )
+
     def get_absolute_url(self):
         return reverse("inventory:log_items", kwargs={"pk": self.pk})
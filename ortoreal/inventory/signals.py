@@ -0,0 +1,47 @@
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, pre_delete
+from django.dispatch import receiver
+
+from clients.models import Job
+from inventory.models import Item, Order
+from inventory.utils import lock_parts, update_part_stock
+
+
+@receiver(post_delete, sender=Order)
+def clear_current_order_cache(sender, instance, **kwargs):
+    """
+    Удаление текущего заказа, в том числе из админки пачкой, сбрасывает
+    кэш его id.
+    """
+    if instance.is_current:
+        transaction.on_commit(Order.clear_current_cache)
+
+
+@receiver(pre_delete, sender=Job)
+@receiver(pre_delete, sender=Order)
+def lock_deleted_stock(sender, instance, **kwargs):
+    """
+    Заблокировать модели комплектующих, остатки которых изменит удаление:
+    у работы снимаются резервы и взятые комплектующие, с заказом
+    удаляются его комплектующие.
+    """
+    if sender is Job:
+        items = Item.objects.filter(Q(job=instance) | Q(reserved=instance))
+    else:
+        items = Item.objects.filter(order=instance)
+    instance.stock_parts = set(
+        items.values_list("part_id", flat=True).distinct().order_by()
+    )
+    lock_parts(instance.stock_parts)
+
+
+@receiver(post_delete, sender=Job)
+@receiver(post_delete, sender=Order)
+def update_deleted_stock(sender, instance, **kwargs):
+    """
+    Пересчитать остатки моделей после удаления работы или заказа.
+    """
+    parts = getattr(instance, "stock_parts", None)
+    if parts:
+        update_part_stock(parts)
@@ -1,11 +1,10 @@
 import locale
 
 from django.conf import settings
-from django.db import models
-from django.db.models import Case, Count, F, Sum, Value, When
-from django.db.models.functions import Concat
+from django.db.models import Case, F, Value, When
 from django.urls import reverse
 from django.utils import timezone
+from django.utils.functional import cached_property
 from django.utils.safestring import mark_safe
 
 import django_tables2 as tables
@@ -14,7 +13,7 @@ from clients.models import Job
 from clients.tables import ItemsColumn
 from core.utils import get_date_display
 from inventory.models import InventoryLog, Item, Order, Part, Prosthesis, Vendor
-from inventory.utils import get_dec_display, wrap_in_color
+from inventory.utils import get_dec_display, get_orders_summary, wrap_in_color
 from users.models import User
 
 TD_END = {
@@ -202,7 +201,43 @@ class OrderTable(VendorOrderTable):
         ]
 
 
-class OrdersTable(tables.Table):
+class OrderSummaryMixin:
+    """
+    Состав и итоговая цена заказов страницы, посчитанные одним запросом.
+    """
+
+    @cached_property
+    def order_summary(self):
+        rows = self.page.object_list if hasattr(self, "page") else self.rows
+        return get_orders_summary([row.record.pk for row in rows])
+
+    def render_parts(self, record):
+        per_line = 6
+        separator = "<br/>"
+        items = []
+        for i, (vendor_code, filled, count) in enumerate(
+            self.order_summary[record.pk].parts, start=1
+        ):
+            if filled == count:
+                color = "green"
+            elif filled == 0:
+                color = "red"
+            else:
+                color = "yellow"
+            items.append(
+                wrap_in_color(color=color, string=f"{vendor_code} ({filled}/{count})")
+            )
+            # вставляем разделение
+            if i % per_line == 0:
+                items.append(separator)
+
+        return mark_safe(" ".join(items))
+
+    def render_total_price(self, record):
+        return get_dec_display(self.order_summary[record.pk].total_price)
+
+
+class OrdersTable(OrderSummaryMixin, tables.Table):
     """
     Таблица списка заказов.
     """
@@ -220,51 +255,6 @@ class OrdersTable(tables.Table):
             value = "Текущий"
         return value
 
-    def render_parts(self, record):
-        per_line = 6
-        separator = "<br/>"
-        parts = (
-            record.items.values("part")
-            .annotate(
-                item_count=Count("id"),
-                items_filled=Count(Case(When(arrived=True, then=1))),
-                color=Case(
-                    When(item_count=F("items_filled"), then=Value("green")),
-                    When(items_filled=0, then=Value("red")),
-                    default=Value("yellow"),
-                    output_field=models.CharField(),
-                ),
-                status=Concat(
-                    F("part__vendor_code"),
-                    Value(" ("),
-                    F("items_filled"),
-                    Value("/"),
-                    F("item_count"),
-                    Value(")"),
-                    output_field=models.CharField(),
-                ),
-            )
-            .order_by("part__vendor_code")
-        )
-
-        items = []
-        for i, part in enumerate(parts):
-            content = wrap_in_color(color=part["color"], string=part["status"])
-            items.append(content)
-            # вставляем разделение
-            if ((len(items) + 1) % (per_line + 1) == 0) and (i < (len(parts) + 1)):
-                items.append(separator)
-
-        return mark_safe(" ".join(items))
-
-    def render_total_price(self, record):
-        price = (
-            Order.objects.filter(pk=record.pk)
-            .annotate(total_price=Sum("items__price"))
-            .values_list("total_price", flat=True)[0]
-        )
-        return get_dec_display(price)
-
     class Meta:
         orderable = False
         model = Order
@@ -310,7 +300,7 @@ class CurrentOrderTable(tables.Table):
         ]
 
 
-class VendorOrdersTable(tables.Table):
+class VendorOrdersTable(OrderSummaryMixin, tables.Table):
     """
     Таблица списка заказов.
     """
@@ -323,52 +313,6 @@ class VendorOrdersTable(tables.Table):
         orderable=False,
     )
 
-    def render_parts(self, record):
-        PER_LINE = 6
-        SEPARATOR = "<br/>"
-
-        parts = (
-            record.items.values("part")
-            .annotate(
-                item_count=Count("id"),
-                items_filled=Count(Case(When(arrived=True, then=1))),
-                color=Case(
-                    When(item_count=F("items_filled"), then=Value("green")),
-                    When(items_filled=0, then=Value("red")),
-                    default=Value("yellow"),
-                    output_field=models.CharField(),
-                ),
-                status=Concat(
-                    F("part__vendor_code"),
-                    Value(" ("),
-                    F("items_filled"),
-                    Value("/"),
-                    F("item_count"),
-                    Value(")"),
-                    output_field=models.CharField(),
-                ),
-            )
-            .order_by("part__vendor_code")
-        )
-
-        items = []
-        for i, part in enumerate(parts):
-            content = wrap_in_color(color=part["color"], string=part["status"])
-            items.append(content)
-            # вставляем разделение
-            if ((len(items) + 1) % (PER_LINE + 1) == 0) and (i < (len(parts) + 1)):
-                items.append(SEPARATOR)
-
-        return mark_safe(" ".join(items))
-
-    def render_total_price(self, record):
-        price = (
-            Order.objects.filter(pk=record.pk)
-            .annotate(total_price=Sum("items__price"))
-            .values_list("total_price", flat=True)[0]
-        )
-        return get_dec_display(price)
-
     class Meta:
         orderable = False
         model = Order
@@ -376,7 +320,6 @@ class VendorOrdersTable(tables.Table):
             "id",
             "date",
             "vendor",
-            "invoice_number",
             "parts",
             "total_price",
         ]
@@ -453,10 +396,10 @@ class JobSetsTable(tables.Table):
     status = tables.Column("Статус", empty_values=())
 
     def render_status(self, record, column):
-        if not record.statuses.exists():
+        if not record.status_name:
             return record.status_display
         # задаём цвет статуса
-        status = record.statuses.latest("date").get_color_display()
+        status = record.get_status_color_display()
         column.attrs = {"td": {"style": f"background: #{status};"}}
         # вставляем перенос строки между статусом и датой статуса
         # rsplit разделяет с конца
@@ -479,7 +422,7 @@ class JobSetsTable(tables.Table):
             "status",
             "reserved_items",
         )
-        exclude = ("date", "items")
+        exclude = ("date", "items", *Job.STATUS_FIELDS)
         row_attrs = {
             "data-href": lambda record: reverse(
                 "inventory:job_set", kwargs={"pk": record.pk}
@@ -534,7 +477,7 @@ class MarginTable(tables.Table):
             "price_items",
             "margin",
         )
-        exclude = ("id",)
+        exclude = ("id", *Job.STATUS_FIELDS)
         template_name = "django_tables2/bootstrap5-responsive.html"
 
 
@@ -1,3 +1,252 @@
-from django.test import TestCase
+import logging
+import threading
+import time
+from datetime import timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+
+from clients.models import Client, Job
+from inventory.models import Item, Order, Part, get_current_order_id
+from inventory.utils import (
+    create_reserve,
+    current_order_part_ids,
+    get_part_stock_counts,
+    get_reserve_candidates_queryset,
+    get_take_candidates,
+    update_part_stock,
+)
+from inventory.views import (
+    FreeOrderEditView,
+    PartItemsListView,
+    TakeItemsView,
+)
+
+User = get_user_model()
+logger = logging.getLogger(__name__)
+
+
+@skipUnless(connection.vendor == "postgresql", "нужны блокировки строк Postgres")
+class ReserveConcurrencyTest(TransactionTestCase):
+    """
+    Параллельные резервы не должны распределять одну комплектующую дважды.
+    """
+
+    THREADS = 8
+    PER_JOB = 2
+    UNITS = 10
+
+    def setUp(self):
+        # база очищается между тестами, id текущего заказа в кэше устарел
+        Order.clear_current_cache()
+        prosthetist = User.objects.create(username="prosthetist", is_prosthetist=True)
+        client = Client.objects.create(
+            last_name="Иванов",
+            first_name="Иван",
+            address="Москва",
+            region=Client.Region.MOSCOW,
+        )
+        now = timezone.now()
+        self.jobs = [
+            Job.objects.create(
+                client=client, prosthetist=prosthetist, date=now + timedelta(hours=i)
+            )
+            for i in range(self.THREADS)
+        ]
+        self.parts = [
+            Part.objects.create(vendor_code=f"P-{i}", name=f"Part {i}")
+            for i in range(self.THREADS + 1)
+        ]
+        Item.objects.bulk_create(
+            Item(part=part, arrived=True)
+            for part in self.parts
+            for _ in range(self.UNITS)
+        )
+        update_part_stock()
+
+    def run_threads(self, target, args_list):
+        errors = []
+        barrier = threading.Barrier(len(args_list))
+
+        def worker(*args):
+            try:
+                barrier.wait()
+                target(*args)
+            except Exception as e:  # noqa: BLE001
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=args) for args in args_list]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        self.assertEqual(errors, [])
+        return elapsed
+
+    def test_same_part_no_double_allocation(self):
+        part = self.parts[-1]
+        self.run_threads(
+            create_reserve, [(part, job, self.PER_JOB) for job in self.jobs]
+        )
+        for job in self.jobs:
+            self.assertEqual(
+                Item.objects.filter(part=part, reserved=job).count(), self.PER_JOB
+            )
+        # склад распределён по самым ранним работам, остальное дозаказано
+        warehouse = Item.objects.filter(part=part, arrived=True)
+        self.assertEqual(warehouse.filter(reserved__isnull=True).count(), 0)
+        earliest = self.jobs[: self.UNITS // self.PER_JOB]
+        self.assertEqual(warehouse.filter(reserved__in=earliest).count(), self.UNITS)
+
+    def test_different_parts_throughput(self):
+        args_list = [
+            (part, job, self.PER_JOB) for part, job in zip(self.parts, self.jobs)
+        ]
+        elapsed = self.run_threads(create_reserve, args_list)
+        logger.info(
+            "%d резервов по разным моделям: %.3f с, %.1f оп/с",
+            len(args_list),
+            elapsed,
+            len(args_list) / elapsed,
+        )
+        for part, job in zip(self.parts, self.jobs):
+            self.assertEqual(
+                Item.objects.filter(part=part, reserved=job).count(), self.PER_JOB
+            )
+
+
+class CurrentOrderIdTest(TestCase):
+    """
+    Id текущего заказа берётся из памяти процесса, пока не сменилась версия.
+    """
+
+    def setUp(self):
+        Order.clear_current_cache()
+
+    def test_cached_until_current_order_changes(self):
+        Order.get_current()
+        with self.captureOnCommitCallbacks(execute=True):
+            order_id = get_current_order_id()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_current_order_id(), order_id)
+        with self.captureOnCommitCallbacks(execute=True):
+            Order.objects.filter(pk=order_id).update(is_current=False)
+            order = Order.objects.get(pk=order_id)
+            order.save()
+        self.assertNotEqual(get_current_order_id(), order_id)
+
+    def test_falls_back_to_database_without_cache(self):
+        order = Order.get_current()
+        with mock.patch(
+            "inventory.models.cache.get", side_effect=ConnectionRefusedError
+        ), self.assertLogs("inventory.models", "WARNING"):
+            self.assertEqual(get_current_order_id(), order.pk)
+            part = Part.objects.create(vendor_code="P-1", name="Part 1")
+            self.assertEqual(Item.objects.create(part=part).order, order)
+
+
+@skipUnless(connection.vendor == "postgresql", "нужен планировщик Postgres")
+class ItemIndexTest(TestCase):
+    """
+    Основные запросы к комплектующим должны идти по индексам.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        prosthetist = User.objects.create(username="prosthetist", is_prosthetist=True)
+        client = Client.objects.create(
+            last_name="Иванов",
+            first_name="Иван",
+            address="Москва",
+            region=Client.Region.MOSCOW,
+        )
+        now = timezone.now()
+        jobs = [
+            Job.objects.create(
+                client=client, prosthetist=prosthetist, date=now + timedelta(hours=i)
+            )
+            for i in range(20)
+        ]
+        cls.job = jobs[0]
+        cls.parts = Part.objects.bulk_create(
+            Part(vendor_code=f"P-{i}", name=f"Part {i}") for i in range(300)
+        )
+        orders = Order.objects.bulk_create(Order(is_current=False) for _ in range(49))
+        cls.order = Order.get_current()
+        orders.append(cls.order)
+        # как на рабочей базе: комплектующие поступают партиями по заказам,
+        # большая часть уже выдана, резервы и свободные заказы редки;
+        # без такого распределения планировщик выберет seq scan
+        items = []
+        for i in range(100):
+            order = orders[i // 2]
+            for n, part in enumerate(cls.parts):
+                items.append(
+                    Item(
+                        part=part,
+                        order=order,
+                        arrived=not order.is_current,
+                        job=jobs[(n + i) % len(jobs)] if i < 90 else None,
+                        reserved=jobs[n % len(jobs)] if i in (90, 91) else None,
+                        free_order=i == 99,
+                    )
+                )
+        Item.objects.bulk_create(items, batch_size=5000)
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def get_plan(self, queryset):
+        # QuerySet.explain() не поддерживает фильтры по оконным функциям
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN {sql}", params)
+            return "\n".join(row[0] for row in cursor.fetchall())
+
+    def assertUsesIndex(self, queryset, index):
+        plan = self.get_plan(queryset)
+        self.assertIn(index, plan, plan)
+
+    def test_key_querysets_use_indexes(self):
+        part = self.parts[0]
+        part_ids = [p.id for p in self.parts[:3]]
+        querysets = {
+            "reserve candidates": (
+                get_reserve_candidates_queryset(*self.parts[:3]),
+                "item_free_part_reserved_idx",
+            ),
+            "take candidates": (
+                get_take_candidates(self.job, {part_id: 2 for part_id in part_ids}),
+                "item_on_hand_part_idx",
+            ),
+            "part stock": (
+                get_part_stock_counts(part_ids),
+                "item_free_part_reserved_idx",
+            ),
+            "part items": (
+                PartItemsListView(kwargs={"pk": part.pk}).get_queryset(),
+                "item_on_hand_part_idx",
+            ),
+            "take parts": (
+                TakeItemsView().get_queryset(self.job),
+                "item_free_part_reserved_idx",
+            ),
+            # счёт модели в заказе, как в OrderView.post
+            "order invoice": (
+                self.order.items.filter(part_id=part.pk),
+                "item_order_part_idx",
+            ),
+            "free order": (
+                FreeOrderEditView().get_initial(),
+                "item_free_order_idx",
+            ),
+        }
+        for name, (queryset, index) in querysets.items():
+            with self.subTest(name):
+                self.assertUsesIndex(queryset, index)
@@ -11,12 +11,27 @@ urlpatterns = [
         name="nomenclature",
     ),
     path("items/<int:pk>/", views.PartItemsListView.as_view(), name="items"),
+    path(
+        "parts/autocomplete/",
+        views.PartAutocompleteView.as_view(),
+        name="part_autocomplete",
+    ),
+    path(
+        "jobs/autocomplete/",
+        views.JobAutocompleteView.as_view(),
+        name="job_autocomplete",
+    ),
     path("reception/", views.ReceptionView.as_view(), name="reception"),
     path(
         "reception/<int:pk>/",
         views.ReceptionInvoiceView.as_view(),
         name="reception_invoice",
     ),
+    path(
+        "reception/import/",
+        views.InvoiceImportView.as_view(),
+        name="invoice_import",
+    ),
     path("take/", views.TakeItemsView.as_view(), name="take_items"),
     path("return/", views.ReturnItemsView.as_view(), name="return_items"),
     path("add_parts/", views.AddPartsView.as_view(), name="add_parts"),
@@ -1,19 +1,58 @@
+import csv
+import hashlib
+import heapq
 import io
+import itertools
 import locale
 import zipfile
-from collections import Counter, OrderedDict
-from decimal import Decimal
+from collections import Counter, OrderedDict, defaultdict, namedtuple
+from decimal import Decimal, InvalidOperation
 from functools import wraps
 
 from django.contrib.auth import get_user_model
-from django.db.models import Case, Count, F, Value, When
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import (
+    Case,
+    Count,
+    F,
+    IntegerField,
+    Q,
+    Sum,
+    Value,
+    When,
+    Window,
+)
+from django.db.models.functions import Coalesce, RowNumber
 from django.shortcuts import get_list_or_404, redirect
 from django.utils import timezone
 
-from inventory.models import Item, Order, Part
+from openpyxl import load_workbook
+from xlsxwriter.workbook import Workbook
+
+from inventory.models import (
+    InventoryLog,
+    Item,
+    Order,
+    Part,
+    PartStock,
+    get_current_order_id,
+)
 
 User = get_user_model()
 
+# изменения резервов: кол-во записанных комплектующих и id затронутых работ
+ReserveChanges = namedtuple("ReserveChanges", ["rows", "jobs"])
+# кэш архивов экспорта заказов: время хранения и максимальный размер записи;
+# размер ограничен записью memcached (1 МБ по умолчанию), архивы больше
+# не кэшируются и собираются заново при каждом скачивании
+EXPORT_CACHE_TIMEOUT = 60 * 60 * 24
+EXPORT_CACHE_MAX_SIZE = 1024 * 1024
+# сводка заказа: строки (артикул, пришло, всего) и итоговая цена
+OrderSummary = namedtuple("OrderSummary", ["parts", "total_price"])
+# строка прихода: модель комплектующей, кол-во, цена и поставщик 2
+ReceptionRow = namedtuple("ReceptionRow", ["part", "quantity", "price", "vendor2"])
+
 
 class OrderedCounter(Counter, OrderedDict):
     """
@@ -48,18 +87,145 @@ def get_dec_display(value):
     return result
 
 
-def generate_zip(files):
+def get_orders_summary(order_ids):
     """
-    Генератор .zip файла.
+    Состав и итоговая цена заказов одним запросом.
+
+    Возвращает словарь {id заказа: OrderSummary}, у заказов без
+    комплектующих итоговая цена None.
     """
-    mem_zip = io.BytesIO()
-    with zipfile.ZipFile(
-        mem_zip, mode="w", compression=zipfile.ZIP_DEFLATED
-    ) as zf:
-        for f in files:
-            zf.writestr(f[0], f[1])
+    parts = defaultdict(list)
+    prices = {}
+    rows = (
+        Item.objects.filter(order_id__in=order_ids)
+        .values("order_id", "part__vendor_code")
+        .annotate(
+            item_count=Count("id"),
+            items_filled=Count("id", filter=Q(arrived=True)),
+            total_price=Sum("price"),
+        )
+        .order_by("order_id", "part__vendor_code")
+    )
+    for row in rows:
+        order_id = row["order_id"]
+        parts[order_id].append(
+            (row["part__vendor_code"], row["items_filled"], row["item_count"])
+        )
+        prices[order_id] = prices.get(order_id, 0) + row["total_price"]
+    return {
+        order_id: OrderSummary(parts[order_id], prices.get(order_id))
+        for order_id in order_ids
+    }
 
-    return mem_zip.getvalue()
+
+def get_order_export_rows(order_id):
+    """
+    Строки экспорта заказа одним запросом, сгруппированные по поставщикам:
+    (id поставщика, поставщик, артикул, кол-во).
+    """
+    return list(
+        Item.objects.filter(order_id=order_id)
+        .values("part__vendor_id", "part")
+        .annotate(
+            vendor=Coalesce(F("part__vendor__name"), Value("-")),
+            vendor_code=F("part__vendor_code"),
+            quantity=Count("id"),
+        )
+        .order_by("vendor", "part__vendor_id", "vendor_code")
+        .values_list("part__vendor_id", "vendor", "vendor_code", "quantity")
+    )
+
+
+def get_order_export_key(order_id, rows):
+    """
+    Ключ кэша архива заказа по хэшу строк, из которых он собирается.
+
+    Архив зависит только от этих строк, поэтому любое изменение
+    комплектующих, артикулов или поставщиков заказа меняет ключ,
+    и устаревший архив по нему не найдётся.
+    """
+    digest = hashlib.sha256(repr(rows).encode()).hexdigest()
+    return f"order_export:{order_id}:{digest}"
+
+
+def iter_cached(chunks, key):
+    """
+    Отдать части файла и сохранить его в кэш, если он отдан целиком
+    и не больше EXPORT_CACHE_MAX_SIZE.
+    """
+    data = []
+    size = 0
+    for chunk in chunks:
+        if data is not None:
+            size += len(chunk)
+            if size <= EXPORT_CACHE_MAX_SIZE:
+                data.append(chunk)
+            else:
+                data = None
+        yield chunk
+    if data is not None:
+        cache.set(key, b"".join(data), EXPORT_CACHE_TIMEOUT)
+
+
+class ZipStreamBuffer(io.RawIOBase):
+    """
+    Буфер записи .zip архива, из которого байты забираются по частям.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def pop(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_zip(files, chunk_size=64 * 1024):
+    """
+    Генератор .zip файла по частям.
+
+    files - итератор пар (имя в архиве, путь к файлу). Архив отдаётся
+    по мере записи и целиком в памяти не собирается.
+    """
+    buffer = ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for name, path in files:
+            with open(path, "rb") as src, zf.open(name, "w") as dst:
+                while chunk := src.read(chunk_size):
+                    dst.write(chunk)
+                    if data := buffer.pop():
+                        yield data
+            if data := buffer.pop():
+                yield data
+    yield buffer.pop()
+
+
+def write_xlsx(path, rows):
+    """
+    Записать строки в .xlsx файл построчно, не держа книгу в памяти.
+    """
+    workbook = Workbook(path, {"constant_memory": True})
+    worksheet = workbook.add_worksheet()
+    widths = []
+    for i, row in enumerate(rows):
+        for j, value in enumerate(row):
+            worksheet.write(i, j, value)
+            width = len(str(value))
+            if j == len(widths):
+                widths.append(width)
+            elif widths[j] < width:
+                widths[j] = width
+    for j, width in enumerate(widths):
+        worksheet.set_column(j, j, width + 2)
+    workbook.close()
 
 
 def is_prosthetist(f):
@@ -151,50 +317,83 @@ def is_prosthetist(f):
 #         Item.objects.bulk_update(batch_update, ["reserved"])
 
 
-def reorg_reserves(part, job=None):
-    # находим все резервы комплектующих, которые ещё не в работе,
-    # и сортируем их от самых ранних работ к самым новым
-    reserved_items = Item.objects.filter(
-        reserved__isnull=False, job=None, part=part
-    ).order_by("reserved__date")
-    #    # если указана работа, то оставляем пересчитываем только те резервы,
-    #    # которые не раньше этой работы.
-    #    if job is not None:
-    #        reserved_items.filter(reserved__date__gte=job.date)
-
-    # запоминаем резервы в нужной последовательности,
-    # т.к. обнулим и назначим заново
-    reserved_items_jobs = reserved_items.values_list("reserved", flat=True)
-    # обнуляем резервы
-    reserved_items.update(reserved=None)
-    # 1. Разбираемся с комплектующими, которые уже есть на складе
-    available_items = Item.objects.filter(
-        job=None, part=part, arrived=True
-    ).order_by("-vendor2", "date")
-    batch_update = []
-    k = 0
-    for item in available_items:
-        if k >= len(reserved_items_jobs):
-            break
-        item.reserved = reserved_items_jobs[k]
-        batch_update.append(item)
-        k += 1
-    # если ещё не прошли по всем резервам, то
-    if k < len(reserved_items_jobs):
-        # 2. Разбираемся с комплектующими в заказах
-        order_items = Item.objects.filter(
-            job=None, part=part, arrived=False
-        ).order_by("order__date")
-        for item in order_items:
-            if k >= len(reserved_items_jobs):
-                break
-            item.reserved = reserved_items_jobs[k]
-            batch_update.append(item)
-            k += 1
+def plan_reorg(items):
+    """
+    Распределить резервы модели комплектующей в памяти.
+
+    Резервы распределяются от самых ранних работ к самым новым: сначала
+    на комплектующие на складе, потом на заказанные.
+    Возвращает список комплектующих, у которых резерв изменился.
+    """
+    # резервы в нужной последовательности, от самых ранних работ
+    reserves = sorted(
+        (i for i in items if i.reserved_id is not None),
+        key=lambda i: (i.reserve_date, i.id),
+    )
+    # 1. комплектующие, которые уже есть на складе
+    available_items = sorted(
+        (i for i in items if i.arrived), key=lambda i: (not i.vendor2, i.date, i.id)
+    )
+    # 2. комплектующие в заказах
+    order_items = sorted(
+        (i for i in items if not i.arrived),
+        key=lambda i: (i.order_date is None, i.order_date or i.date, i.id),
+    )
+    targets = available_items + order_items
+
+    # целевое распределение: резервы по порядку на комплектующие по порядку,
+    # внутри склада и внутри одного заказа порядок неважен, поэтому
+    # комплектующие, у которых резерв уже подходит, не трогаем
+    groups = OrderedDict()
+    for item, reserve in zip(targets, reserves):
+        key = "arrived" if item.arrived else item.order_id
+        group_items, group_jobs = groups.setdefault(key, ([], []))
+        group_items.append(item)
+        group_jobs.append((reserve.reserved_id, reserve.reserve_date))
+    new_reserves = {item.id: (None, None) for item in targets[len(reserves) :]}
+    for group_items, group_jobs in groups.values():
+        jobs_left = Counter(group_jobs)
+        items_left = []
+        for item in group_items:
+            reserve = (item.reserved_id, item.reserve_date)
+            if jobs_left[reserve] > 0:
+                jobs_left[reserve] -= 1
+                new_reserves[item.id] = reserve
+            else:
+                items_left.append(item)
+        for item, reserve in zip(items_left, jobs_left.elements()):
+            new_reserves[item.id] = reserve
+
+    changed = []
+    for item in targets:
+        reserved_id, reserve_date = new_reserves[item.id]
+        if item.reserved_id == reserved_id:
+            continue
+        item.reserved_id = reserved_id
+        item.reserve_date = reserve_date
+        changed.append(item)
 
+    return changed
+
+
+@transaction.atomic
+def reorg_reserves(part, job=None):
+    """
+    Пересчитать резервы модели комплектующей.
+    Записываются только комплектующие, у которых резерв изменился.
+    """
+    lock_parts([part])
+    items = get_reserve_candidates(part)
+    old_reserves = {item.id: item.reserved_id for item in items}
+    batch_update = plan_reorg(items)
     if batch_update:
         Item.objects.bulk_update(batch_update, ["reserved"])
 
+    jobs = set()
+    for item in batch_update:
+        jobs.update(filter(None, (old_reserves[item.id], item.reserved_id)))
+    return ReserveChanges(rows=len(batch_update), jobs=jobs)
+
 
 # def create_reserve(part, job, quantity):
 #     """
@@ -238,275 +437,847 @@ def reorg_reserves(part, job=None):
 #     return quantity
 
 
-def create_reserve(part, job, quantity, job_dict=OrderedCounter()):
+def get_reserve_candidates_queryset(*parts):
     """
-    Зарезервировать комплектующие. Новая версия.
+    Queryset комплектующих моделей, которые ещё не в работе,
+    с датами резерва и заказа.
     """
-
-    # 1. Сначала разбираемся с остатками на складе.
-    unused_in_warehouse = Item.objects.filter(
-        job=None, reserved=None, part=part, arrived=True
-    ).order_by("-vendor2")
-    if unused_in_warehouse.exists():
-        # если запрашиваемое кол-во <= кол-ва на складе
-        if quantity <= unused_in_warehouse.count():
-            # берём срез из того, что на складе
-            unused_in_warehouse = unused_in_warehouse[:quantity]
-            quantity = 0
-        else:
-            # берём, что есть, а кол-во уменьшаем для следующего этапа
-            quantity -= unused_in_warehouse.count()
-        # резервируем получившиеся незанятые
-        for item in unused_in_warehouse:
-            item.reserved = job
-        Item.objects.bulk_update(unused_in_warehouse, ["reserved"])
-    # если все нужные резервы созданы, то выходим
-    if not quantity:
-        return "unused only"
-
-    # 2. Теперь ищем среди самых новых работ, у которых уже на складе,
-    #    забираем у них, а в конце возьмём из старых заказов или дозакажем,
-    #    но сначала для нашей работы
-    newest_reserves = Item.objects.filter(
-        job=None,
-        part=part,
-        reserved__isnull=False,
-        reserved__date__gt=job.date,
-        arrived=True,
-    ).order_by("-reserved__date")
-    # список работ, для которых нужно будет дозаказать
-    jobs_to_reserve_for = []
-    if newest_reserves.exists():
-        # если запрашиваемое кол-во <= кол-ва в резервах у других
-        if quantity <= newest_reserves.count():
-            # то берём срез из других резервов
-            newest_reserves = newest_reserves[:quantity]
-            quantity = 0
-        else:
-            # берём, что есть, а кол-во уменьшаем для следующего этапа
-            quantity -= newest_reserves.count()
-        # проходим по резервам
-        for item in newest_reserves:
-            # добавляем работы в список
-            jobs_to_reserve_for.append(item.reserved)
-            # записываем резерв на нашу работу
-            item.reserved = job
-        Item.objects.bulk_update(newest_reserves, ["reserved"])
-    #    # находим незарезервированные во всех заказах, начиная с самого раннего
-    #    unreserved_in_orders = Item.objects.filter(
-    #        part=part, warehouse__isnull=True, reserved__isnull=True
-    #    ).order_by("order__date", "order__current")
-
-    # 3. Если нужно ещё, то проходим по самым ранним заказанным,
-    #    но ещё не на складе
-    if quantity:
-        # в самом раннем заказе ставим в начало комплектующие без резерва,
-        # потом самые новые с резервом
-        ordered_reserves = (
-            Item.objects.filter(job=None, arrived=False, part=part)
-            .annotate(
-                reserve_date=Case(
-                    # если нет резерва, то записываем сегодняшние дату и время
-                    When(reserved__isnull=True, then=Value(timezone.now())),
-                    default=F("reserved__date"),
-                )
-            )
-            # оставляем только резервы с датой больше, чем у нашей работы
-            .filter(reserve_date__gt=job.date)
-            .order_by("order__date", "reserve_date")
+    return (
+        Item.objects.filter(part__in=parts, job=None)
+        .annotate(
+            reserve_date=F("reserved__date"),
+            order_date=F("order__date"),
+            order_is_current=F("order__is_current"),
         )
+        .order_by("id")
+    )
 
-        if ordered_reserves.exists():
-            # если запрашиваемое кол-во <= кол-ва в непришедших заказах
-            if quantity <= ordered_reserves.count():
-                ordered_reserves = ordered_reserves[:quantity]
-                quantity = 0
-            else:
-                quantity -= ordered_reserves
-
-        # проходим комплектующим в заказах
-        for item in ordered_reserves:
-            # если у комплектующей есть резерв, то вносим её работу в список
-            if item.reserved is not None:
-                jobs_to_reserve_for.append(item.reserved)
-            # записываем резерв на нашу работу
-            item.reserved = job
-        Item.objects.bulk_update(ordered_reserves, ["reserved"])
-    # сортируем работы, для которых нужно заново зарезервировать комплектующие
-    jobs_to_reserve_for.sort(key=lambda x: x.date)
-    # 4. Если так получилось, что не хватило и того, что уже в заказах,
-    #    то добавляем всё в текущий заказ
-    if quantity:
-        order = Order.get_current()
-        # создаём партию из недостающих комплектующих
-        batch_create = [Item(part=part, reserved=job, order=order)] * quantity
-        # добавляем в неё недостающие комплектующие более новых работ
-        for job_reserve in jobs_to_reserve_for:
-            batch_create.append(
-                Item(part=part, reserved=job_reserve, order=order)
-            )
-        Item.objects.bulk_create(batch_create)
-        return "ordered more"
-
-    # 5. Если хватило в заказах, то нужно разобраться с резервами для работ,
-    #    которые помещены в список.
-    job_dict.update(OrderedCounter(jobs_to_reserve_for))
-    if job_dict:
-        next_job, next_quantity = job_dict.popitem(last=False)
-        # повторяем для следующей работы
-        create_reserve(part, next_job, next_quantity, job_dict)
-    else:
-        print("all done")
 
+def get_reserve_candidates(*parts):
+    """
+    Все комплектующие моделей, которые ещё не в работе,
+    с датами резерва и заказа для распределения в памяти.
+    """
+    return list(get_reserve_candidates_queryset(*parts))
 
-def remove_reserve(part, job, quantity):
+
+def allocate_reserves(items, demands):
     """
-    Снять резерв.
+    Распределить комплектующие по работам в памяти.
+
+    demands - словарь {id работы: (дата работы, кол-во)}.
+    Работы обрабатываются от самой ранней к самой новой. Если комплектующая
+    забрана из резерва более новой работы, то её работа снова попадает
+    в очередь на резерв.
+
+    Возвращает список изменённых комплектующих и словарь
+    {id работы: кол-во} недостающих, которые нужно дозаказать.
     """
-    reserved_items = (
-        Item.objects.filter(job=None, reserved=job, part=part)
-        .annotate(
-            new_old_warehouse=Case(
-                When(order__is_current=True, then=1),
-                When(order__is_current=False, then=2),
-                default=3,
-            )
+    pending = {}
+    queue = []
+
+    def add_demand(job_id, job_date, quantity):
+        if job_id not in pending:
+            pending[job_id] = [job_date, 0]
+            heapq.heappush(queue, (job_date, job_id))
+        pending[job_id][1] += quantity
+
+    for job_id, (job_date, quantity) in demands.items():
+        if quantity > 0:
+            add_demand(job_id, job_date, quantity)
+
+    changed = {}
+    missing = OrderedCounter()
+    while queue:
+        job_date, job_id = heapq.heappop(queue)
+        quantity = pending.pop(job_id)[1]
+
+        # 1. Незанятые на складе, в первую очередь от поставщика 2
+        unused = sorted(
+            (i for i in items if i.arrived and i.reserved_id is None),
+            key=lambda i: (not i.vendor2, i.date, i.id),
         )
-        .order_by("new_old_warehouse", "vendor2", "-date")
+        # 2. Резервы более новых работ на складе, начиная с самых новых
+        newest = sorted(
+            (
+                i
+                for i in items
+                if i.arrived
+                and i.reserved_id is not None
+                and i.reserve_date > job_date
+            ),
+            key=lambda i: (i.reserve_date, i.id),
+            reverse=True,
+        )
+        # 3. Ещё не пришедшие, начиная с самого раннего заказа:
+        #    сначала без резерва, потом резервы самых новых работ
+        ordered = sorted(
+            (
+                i
+                for i in items
+                if not i.arrived
+                and (i.reserved_id is None or i.reserve_date > job_date)
+            ),
+            key=lambda i: (
+                i.order_date is None,
+                i.order_date.timestamp() if i.order_date else 0,
+                i.reserved_id is not None,
+                -i.reserve_date.timestamp() if i.reserve_date else 0,
+                i.id,
+            ),
+        )
+
+        for item in itertools.chain(unused, newest, ordered):
+            if not quantity:
+                break
+            # у работы забрали резерв, значит ей нужно зарезервировать заново
+            if item.reserved_id is not None:
+                add_demand(item.reserved_id, item.reserve_date, 1)
+            item.reserved_id = job_id
+            item.reserve_date = job_date
+            changed[item.id] = item
+            quantity -= 1
+
+        # 4. Недостающие дозаказываем в текущий заказ
+        if quantity:
+            missing[job_id] += quantity
+
+    return list(changed.values()), missing
+
+
+@transaction.atomic
+def create_reserves(part, demands):
+    """
+    Зарезервировать комплектующие модели для нескольких работ.
+
+    demands - словарь {работа: кол-во}.
+    Возвращает кол-во комплектующих, добавленных в текущий заказ.
+    """
+    lock_parts([part])
+    items = get_reserve_candidates(part)
+    batch_update, missing = allocate_reserves(
+        items, {job.pk: (job.date, quantity) for job, quantity in demands.items()}
     )
-    if quantity <= reserved_items.count():
-        reserved_items = reserved_items[:quantity]
-    else:
-        quantity = reserved_items.count()
+    if batch_update:
+        Item.objects.bulk_update(batch_update, ["reserved"])
+
+    if missing:
+        order_id = get_current_order_id()
+        Item.objects.bulk_create(
+            Item(part=part, reserved_id=job_id, order_id=order_id)
+            for job_id, quantity in missing.items()
+            for _ in range(quantity)
+        )
 
-    batch = []
-    for item in reserved_items:
+    update_part_stock([part])
+    return sum(missing.values())
+
+
+def create_reserve(part, job, quantity):
+    """
+    Зарезервировать комплектующие.
+    """
+    return create_reserves(part, {job: quantity})
+
+
+def plan_remove_reserve(items, job_id, quantity):
+    """
+    Снять резерв работы в памяти.
+
+    В первую очередь снимаются резервы в текущем заказе, потом в старых
+    заказах, потом на складе. Возвращает списки комплектующих
+    на обновление и на удаление из текущего заказа.
+    """
+    reserved_items = sorted(
+        (i for i in items if i.reserved_id == job_id),
+        key=lambda i: (
+            1 if i.order_is_current else 2 if i.order_id else 3,
+            i.vendor2,
+            -i.date.timestamp(),
+            -i.id,
+        ),
+    )
+    batch_update = []
+    batch_delete = []
+    for item in reserved_items[:quantity]:
         # Если не из свободного заказа и в текущем заказе
-        if not item.free_order and item.order and item.order.is_current:
-            item.delete()
+        if not item.free_order and item.order_is_current:
+            batch_delete.append(item)
         else:
-            item.reserved = None
-            batch.append(item)
+            item.reserved_id = None
+            item.reserve_date = None
+            batch_update.append(item)
+
+    return batch_update, batch_delete
 
-    if batch:
-        Item.objects.bulk_update(batch, ["reserved"])
 
+@transaction.atomic
+def remove_reserve(part, job, quantity):
+    """
+    Снять резерв.
+    """
+    lock_parts([part])
+    items = get_reserve_candidates(part)
+    batch_update, batch_delete = plan_remove_reserve(items, job.pk, quantity)
+    if batch_update:
+        Item.objects.bulk_update(batch_update, ["reserved"])
+    if batch_delete:
+        Item.objects.filter(id__in=[item.id for item in batch_delete]).delete()
+
+    update_part_stock([part])
     # возвращаем кол-во освобожденных резервов
-    return quantity
+    return len(batch_update) + len(batch_delete)
 
 
-def check_minimum_remainder():
+@transaction.atomic
+def set_job_kit(job, kit):
     """
-    Проверить неснижаемый остаток и добавить нехватки в текущий заказ.
+    Записать комплект работы целиком.
+
+    kit - словарь {id модели комплектующей: кол-во}.
+    Разница с текущими резервами считается одним запросом, все модели
+    распределяются в памяти и записываются пачками.
+    Возвращает кол-во комплектующих, добавленных в текущий заказ.
     """
-    remaining_parts = (
-        Part.objects.filter(
-            minimum_remainder__isnull=False,
-            items__reserved__isnull=True,
-            items__job__isnull=True,
+    current_reserves = (
+        Item.objects.filter(reserved=job)
+        .values("part")
+        .annotate(quantity=Count("id"))
+        .values_list("part", "quantity")
+        .order_by()
+    )
+    current = dict(current_reserves)
+    # блокируем модели и перечитываем резервы, т.к. до блокировки
+    # их могли забрать более ранние работы
+    lock_parts(set(kit) | set(current))
+    current = dict(current_reserves.all())
+    deltas = {
+        part_id: kit.get(part_id, 0) - current.get(part_id, 0)
+        for part_id in set(kit) | set(current)
+    }
+    deltas = {part_id: delta for part_id, delta in deltas.items() if delta}
+    if not deltas:
+        return 0
+
+    part_items = defaultdict(list)
+    for item in get_reserve_candidates(*deltas):
+        part_items[item.part_id].append(item)
+
+    batch_update = {}
+    batch_delete = []
+    missing = []
+    for part_id, delta in deltas.items():
+        items = part_items[part_id]
+        if delta > 0:
+            changed, part_missing = allocate_reserves(
+                items, {job.pk: (job.date, delta)}
+            )
+            missing += [
+                (part_id, job_id)
+                for job_id, quantity in part_missing.items()
+                for _ in range(quantity)
+            ]
+        else:
+            changed, deleted = plan_remove_reserve(items, job.pk, -delta)
+            batch_delete += deleted
+            # пересчитываем резервы без удалённых из текущего заказа
+            deleted = {item.id for item in deleted}
+            changed += plan_reorg([i for i in items if i.id not in deleted])
+        for item in changed:
+            batch_update[item.id] = item
+
+    if batch_update:
+        Item.objects.bulk_update(batch_update.values(), ["reserved"])
+    if batch_delete:
+        Item.objects.filter(id__in=[item.id for item in batch_delete]).delete()
+    if missing:
+        order_id = get_current_order_id()
+        Item.objects.bulk_create(
+            Item(part_id=part_id, reserved_id=job_id, order_id=order_id)
+            for part_id, job_id in missing
+        )
+
+    update_part_stock(deltas)
+    return len(missing)
+
+
+def get_take_candidates(job, quantities):
+    """
+    Комплектующие на складе, которые работа может взять.
+
+    quantities - словарь {id модели: кол-во}. Кандидаты всех моделей
+    выбираются одним запросом, нужное кол-во отрезается по номеру строки
+    внутри модели.
+    """
+    return (
+        Item.objects.filter(
+            Q(reserved=job) | Q(reserved=None) | Q(reserved__date__gt=job.date),
+            part_id__in=quantities,
+            arrived=True,
+            job=None,
         )
-        .exclude(minimum_remainder=0)
-        .annotate(item_count=Count("items"))
+        .annotate(
+            reserve_date=F("reserved__date"),
+            row=Window(
+                RowNumber(),
+                partition_by=F("part_id"),
+                order_by=[F("vendor2").desc(), F("date").asc(), F("id").asc()],
+            ),
+        )
+        .filter(row__lte=get_part_quantity_case(quantities))
+        .order_by("part_id", "row")
     )
 
-    order = Order.get_current()
-    batch_create = []
-    for part in remaining_parts:
-        if part.minimum_remainder > part.item_count:
-            quantity = part.minimum_remainder - part.item_count
-            batch_create += [Item(part=part, order=order)] * quantity
 
+@transaction.atomic
+def take_items(job, quantities, comment=""):
+    """
+    Выдать комплектующие в работу.
+
+    quantities - словарь {модель комплектующей: кол-во}, на каждую модель
+    создаётся запись лога. Берутся свои резервы, свободные и резервы более
+    новых работ, в первую очередь самые старые от поставщика 2.
+    Чужие резервы пересоздаются для их работ.
+    """
+    quantities = {
+        getattr(part, "pk", part): quantity
+        for part, quantity in quantities.items()
+        if quantity and quantity > 0
+    }
+    if not quantities:
+        return []
+    lock_parts(quantities)
+
+    items = list(get_take_candidates(job, quantities))
+
+    # у каких работ и сколько взяли из резерва
+    displaced = defaultdict(OrderedCounter)
+    reserve_dates = {}
+    part_items = defaultdict(list)
+    for item in items:
+        part_items[item.part_id].append(item)
+        if item.reserved_id not in (None, job.pk):
+            displaced[item.part_id][item.reserved_id] += 1
+            reserve_dates[item.reserved_id] = item.reserve_date
+
+    Item.objects.filter(id__in=[item.id for item in items]).update(
+        job=job, reserved=job
+    )
+    parts = Part.objects.in_bulk(quantities)
+    logs = InventoryLog.objects.bulk_create(
+        InventoryLog.for_part(
+            parts[part_id],
+            len(part_items[part_id]),
+            operation=InventoryLog.Operation.TAKE,
+            job=job,
+            prosthetist_id=job.prosthetist_id,
+            comment=comment,
+        )
+        for part_id in quantities
+    )
+    LogItem = InventoryLog.items.through
+    LogItem.objects.bulk_create(
+        LogItem(inventorylog_id=log.pk, item_id=item.id)
+        for log, part_id in zip(logs, quantities)
+        for item in part_items[part_id]
+    )
+
+    # пересоздаём резервы для всех, у кого взяли
+    if displaced:
+        candidates = defaultdict(list)
+        for item in get_reserve_candidates(*displaced):
+            candidates[item.part_id].append(item)
+        batch_update = []
+        missing = []
+        for part_id, demands in displaced.items():
+            changed, part_missing = allocate_reserves(
+                candidates[part_id],
+                {
+                    job_id: (reserve_dates[job_id], quantity)
+                    for job_id, quantity in demands.items()
+                },
+            )
+            batch_update += changed
+            missing += [
+                (part_id, job_id)
+                for job_id, quantity in part_missing.items()
+                for _ in range(quantity)
+            ]
+        if batch_update:
+            Item.objects.bulk_update(batch_update, ["reserved"])
+        if missing:
+            order_id = get_current_order_id()
+            Item.objects.bulk_create(
+                Item(part_id=part_id, reserved_id=job_id, order_id=order_id)
+                for part_id, job_id in missing
+            )
+
+    update_part_stock(quantities)
+    return logs
+
+
+def get_remainder_shortfalls(parts=None):
+    """
+    Нехватка до неснижаемого остатка по моделям комплектующих одним запросом.
+
+    Остатком считаются незарезервированные комплектующие, которые не взяты
+    в работу: на складе и в заказах. Возвращает словарь {id модели: кол-во}.
+    """
+    queryset = Part.objects.filter(minimum_remainder__gt=0)
+    if parts is not None:
+        queryset = queryset.filter(pk__in={getattr(part, "pk", part) for part in parts})
+    queryset = queryset.annotate(
+        remainder=Count("items", filter=Q(items__reserved=None, items__job=None))
+    ).filter(remainder__lt=F("minimum_remainder"))
+    return {
+        part_id: minimum_remainder - remainder
+        for part_id, minimum_remainder, remainder in queryset.values_list(
+            "id", "minimum_remainder", "remainder"
+        )
+    }
+
+
+@transaction.atomic
+def check_minimum_remainder():
+    """
+    Проверить неснижаемый остаток и добавить нехватки в текущий заказ.
+    """
+    shortfalls = get_remainder_shortfalls()
+    if not shortfalls:
+        return 0
+    # блокируем модели и пересчитываем, т.к. до блокировки остаток мог измениться
+    lock_parts(shortfalls)
+    shortfalls = get_remainder_shortfalls(shortfalls)
+
+    order_id = get_current_order_id()
+    batch_create = [
+        Item(part_id=part_id, order_id=order_id)
+        for part_id, quantity in shortfalls.items()
+        for _ in range(quantity)
+    ]
     if batch_create:
         Item.objects.bulk_create(batch_create)
+        update_part_stock(shortfalls)
 
     return len(batch_create)
 
 
-def move_reserves_to_free_order():
+def move_reserves_to_free_order(parts=None):
     """
     Переместить резервы из обычных заказов в свободный, если есть незанятые.
+
+    Незанятые комплектующие свободного заказа и зарезервированные обычного
+    нумеруются внутри модели и сопоставляются по номеру: резерв переписывается
+    одним обновлением, обычные комплектующие удаляются одним запросом.
+    Если модели не указаны, то проверяются все.
     """
-    current_order = Order.get_current()
-    unreserved_free_order = current_order.items.filter(
-        reserved__isnull=True, free_order=True
-    )
-    reserved_regular_order = current_order.items.filter(
-        reserved__isnull=False, free_order=False
+    items = Item.objects.filter(
+        Q(free_order=True, reserved=None) | Q(free_order=False, reserved__isnull=False),
+        order_id=get_current_order_id(),
     )
-    parts_free_order = Part.objects.filter(
-        items__free_order=True,
-        items__order__is_current=True,
-        items__reserved__isnull=True,
-    ).annotate(item_count=Count("items"))
-    parts_regular_order = Part.objects.filter(
-        items__free_order=False,
-        items__order__is_current=True,
-        items__reserved__isnull=False,
-    ).annotate(item_count=Count("items"))
-    batch_update = []
-    for part in parts_regular_order:
-        if part in parts_free_order:
-            quantity = part.item_count
-            free_order_items = unreserved_free_order.filter(part=part)
-            regular_order_items = reserved_regular_order.filter(part=part)
-            # берём срез до кол-ва комплектующих в обычном резерве
-            free_order_items = free_order_items[:quantity]
-            # если в свободном оказалось меньше, то кол-во можно переписать
-            quantity = free_order_items.count()
-            for i, item in enumerate(regular_order_items[:quantity]):
-                # переписываем резерв на свободный заказ и удаляем из обычного
-                free_order_items[i].reserved = item.reserved
-                batch_update.append(free_order_items[i])
-                item.delete()
+    if parts is not None:
+        items = items.filter(part_id__in={getattr(part, "pk", part) for part in parts})
+    items = items.annotate(
+        row=Window(
+            RowNumber(),
+            partition_by=[F("part_id"), F("free_order")],
+            # резервы более ранних работ переносятся первыми
+            order_by=[F("reserved__date").asc(nulls_last=True), F("id").asc()],
+        )
+    ).values_list("id", "part_id", "free_order", "reserved_id", "row")
 
-    if batch_update:
-        Item.objects.bulk_update(batch_update, ["reserved"])
+    free_items = {}
+    regular_items = {}
+    for item_id, part_id, free_order, reserved_id, row in items:
+        if free_order:
+            free_items[part_id, row] = item_id
+        else:
+            regular_items[part_id, row] = (item_id, reserved_id)
+    pairs = [
+        (free_items[key], item_id, reserved_id)
+        for key, (item_id, reserved_id) in regular_items.items()
+        if key in free_items
+    ]
+    if not pairs:
+        return 0
 
-    return len(batch_update)
+    Item.objects.filter(id__in=[free_id for free_id, _, _ in pairs]).update(
+        reserved_id=Case(
+            *(
+                When(id=free_id, then=Value(reserved_id))
+                for free_id, _, reserved_id in pairs
+            ),
+            output_field=IntegerField(),
+        )
+    )
+    Item.objects.filter(id__in=[item_id for _, item_id, _ in pairs]).delete()
+    return len(pairs)
 
 
-def remove_excess_from_current_order():
+def remove_excess_from_current_order(parts=None):
     """
     Удалить излишки из текущего заказа.
+
+    Удаляются незарезервированные комплектующие текущего заказа, заказанные
+    обычным способом, сверх неснижаемого остатка модели. Если модели
+    не указаны, то проверяются все.
     """
-    # незарезервированные в текущем заказе, заказанные обычным способом
-    unreserved_current = Item.objects.filter(
-        reserved__isnull=True,
-        order__is_current=True,
-        arrived=False,
-        free_order=False,
-    )
     # всего в остатке
-    parts_remainder = Part.objects.filter(
-        items__reserved__isnull=True, items__job__isnull=True
-    ).annotate(item_count=Count("items"))
-    parts_unreserved_current = Part.objects.filter(
-        items__reserved__isnull=True,
-        items__order__is_current=True,
-        items__free_order=False,
+    remainders = Item.objects.filter(reserved=None, job=None)
+    if parts is not None:
+        part_ids = {getattr(part, "pk", part) for part in parts}
+        if not part_ids:
+            return 0
+        remainders = remainders.filter(part_id__in=part_ids)
+    excess = {}
+    for part_id, count, min_remainder in (
+        remainders.values("part_id")
+        .annotate(count=Count("id"))
+        .values_list("part_id", "count", "part__minimum_remainder")
+        .order_by()
+    ):
+        quantity = count - max(min_remainder or 0, 0)
+        if quantity > 0:
+            excess[part_id] = quantity
+    if not excess:
+        return 0
+
+    # незарезервированные в текущем заказе, заказанные обычным способом,
+    # удаляются начиная с последних добавленных
+    unreserved_current = (
+        Item.objects.filter(
+            part_id__in=excess,
+            reserved=None,
+            order__is_current=True,
+            arrived=False,
+            free_order=False,
+        )
+        .annotate(
+            row=Window(RowNumber(), partition_by=F("part_id"), order_by=F("id").desc())
+        )
+        .filter(row__lte=get_part_quantity_case(excess))
     )
-    batch_delete = []
-    for part in parts_remainder:
-        if part in parts_unreserved_current:
-            quantity = part.item_count
-            # если у комплектующей есть неснижаемый остаток,
-            # то меняем кол-во удаляемых
-            min_remainder = part.minimum_remainder
-            if (
-                min_remainder is not None
-                and min_remainder != 0
-                and part.item_count > min_remainder
-            ):
-                quantity = part.item_count - min_remainder
-            # добавляем срез комплектующих на удаление
-            items = unreserved_current.filter(part=part)
-            batch_delete += list(items[:quantity])
+    _, deleted = Item.objects.filter(id__in=unreserved_current.values("id")).delete()
+    return deleted.get(Item._meta.label, 0)
 
-    if batch_delete:
-        for item in batch_delete:
-            item.delete()
 
-    return len(batch_delete)
+def get_part_quantity_case(quantities):
+    """
+    Выражение кол-ва для каждой модели комплектующей из словаря
+    {id модели: кол-во}, чтобы отрезать нужное кол-во по номеру строки.
+    """
+    return Case(
+        *(
+            When(part_id=part_id, then=Value(quantity))
+            for part_id, quantity in quantities.items()
+        ),
+        output_field=IntegerField(),
+    )
+
+
+@transaction.atomic
+def close_current_order():
+    """
+    Закрыть текущий заказ, разбив его на заказы по поставщикам.
+
+    Модели комплектующих группируются по поставщику одним запросом,
+    заказы создаются пачкой, а комплектующие переносятся одним обновлением.
+    Возвращает созданные заказы.
+    """
+    current_items = Item.objects.filter(order_id=get_current_order_id())
+    vendor_parts = defaultdict(list)
+    for vendor_id, part_id in (
+        current_items.values_list("part__vendor_id", "part_id").distinct().order_by()
+    ):
+        vendor_parts[vendor_id].append(part_id)
+    if not vendor_parts:
+        return []
+    lock_parts(itertools.chain.from_iterable(vendor_parts.values()))
+
+    orders = Order.objects.bulk_create(
+        Order(vendor_id=vendor_id) for vendor_id in vendor_parts
+    )
+    current_items.update(
+        order_id=Case(
+            *(
+                When(part_id__in=part_ids, then=Value(order.pk))
+                for order, part_ids in zip(orders, vendor_parts.values())
+            ),
+            # добавленные после группировки остаются в текущем заказе
+            default=F("order_id"),
+            output_field=IntegerField(),
+        )
+    )
+    update_part_stock(itertools.chain.from_iterable(vendor_parts.values()))
+    return orders
+
+
+def lock_parts(parts):
+    """
+    Заблокировать строки остатков моделей комплектующих до конца транзакции.
+
+    Операции с одной моделью выполняются по очереди, а операции с разными
+    моделями не мешают друг другу. Строки блокируются по возрастанию id,
+    чтобы избежать взаимных блокировок.
+    """
+    part_ids = sorted({getattr(part, "pk", part) for part in parts})
+    if not part_ids:
+        return
+    stocks = PartStock.objects.select_for_update().filter(part_id__in=part_ids)
+    locked = list(stocks.order_by("part_id").values_list("part_id", flat=True))
+    if len(locked) < len(part_ids):
+        # у новых моделей ещё нет строки остатков
+        PartStock.objects.bulk_create(
+            [PartStock(part_id=part_id) for part_id in part_ids],
+            ignore_conflicts=True,
+        )
+        list(stocks.order_by("part_id").values_list("part_id", flat=True))
+
+
+def current_order_part_ids():
+    """
+    Id моделей комплектующих, которые есть в текущем заказе.
+    """
+    return set(
+        Item.objects.filter(order__is_current=True)
+        .values_list("part_id", flat=True)
+        .distinct()
+    )
+
+
+def get_part_stock_counts(part_ids=None):
+    """
+    Кол-во комплектующих для сводки остатков по моделям одним запросом.
+    Если модели не указаны, то считаются все.
+    """
+    items = Item.objects.filter(job=None)
+    if part_ids is not None:
+        items = items.filter(part_id__in=part_ids)
+    return (
+        items.values("part_id")
+        .annotate(
+            on_hand_count=Count("id", filter=Q(arrived=True)),
+            available_count=Count("id", filter=Q(arrived=True, reserved=None)),
+            reserved_count=Count(
+                "id", filter=Q(arrived=True, reserved__isnull=False)
+            ),
+            on_order_count=Count(
+                "id", filter=Q(arrived=False, order__is_current=False)
+            ),
+            in_current_order_count=Count(
+                "id", filter=Q(arrived=False, order__is_current=True)
+            ),
+        )
+        .order_by()
+    )
+
+
+def update_part_stock(parts=None):
+    """
+    Пересчитать сводку остатков для указанных моделей комплектующих.
+    Если модели не указаны, то пересчитываются все.
+    """
+    if parts is None:
+        part_ids = set(Part.objects.values_list("id", flat=True))
+        counts = get_part_stock_counts()
+    else:
+        part_ids = {getattr(part, "pk", part) for part in parts}
+        counts = get_part_stock_counts(part_ids)
+    if not part_ids:
+        return 0
+
+    # модели, у которых не осталось записей, обнуляем
+    stocks = {part_id: PartStock(part_id=part_id) for part_id in part_ids}
+    for row in counts:
+        stock = stocks[row["part_id"]]
+        stock.on_hand = row["on_hand_count"]
+        stock.available = row["available_count"]
+        stock.reserved = row["reserved_count"]
+        stock.on_order = row["on_order_count"]
+        stock.in_current_order = row["in_current_order_count"]
+
+    PartStock.objects.bulk_create(
+        stocks.values(),
+        update_conflicts=True,
+        unique_fields=["part"],
+        update_fields=[
+            "on_hand",
+            "available",
+            "reserved",
+            "on_order",
+            "in_current_order",
+        ],
+    )
+    return len(stocks)
+
+
+@transaction.atomic
+def receive_items(rows, date, comment="", invoice=None):
+    """
+    Оприходовать комплектующие за фиксированное число запросов.
+
+    rows - строки прихода ReceptionRow, на каждую создаётся запись лога.
+    Сначала приходуются заказанные комплектующие (без счёта или по счёту
+    invoice), раньше - зарезервированные под более ранние работы,
+    на остаток создаются новые записи.
+    """
+    rows = [row for row in rows if row.quantity and row.quantity > 0]
+    if not rows:
+        return []
+    parts = {row.part.pk for row in rows}
+    lock_parts(parts)
+
+    # заказанные комплектующие всех моделей прихода одним запросом
+    ordered_items = Item.objects.filter(
+        part_id__in=parts, arrived=False, order__is_current=False
+    )
+    if invoice is None:
+        ordered_items = ordered_items.filter(invoice__isnull=True)
+        extra = {}
+    else:
+        ordered_items = ordered_items.filter(invoice=invoice)
+        extra = {"invoice": invoice, "order_id": invoice.order_id}
+    ordered_by_part = defaultdict(list)
+    for item in ordered_items.order_by(
+        F("reserved__date").asc(nulls_last=True), F("id").asc()
+    ):
+        ordered_by_part[item.part_id].append(item)
+
+    batch_update = []
+    batch_create = []
+    log_items = []
+    for row in rows:
+        ordered = ordered_by_part[row.part.pk]
+        matched = ordered[: row.quantity]
+        del ordered[: row.quantity]
+        for item in matched:
+            item.date = date
+            item.arrived = True
+            item.vendor2 = row.vendor2
+        created = [
+            Item(
+                part=row.part,
+                arrived=True,
+                vendor2=row.vendor2,
+                price=row.price,
+                date=date,
+                **extra,
+            )
+            for _ in range(row.quantity - len(matched))
+        ]
+        batch_update += matched
+        batch_create += created
+        log_items.append(matched + created)
+
+    Item.objects.bulk_update(batch_update, ["date", "arrived", "vendor2"])
+    # Postgres возвращает id созданных записей, перезапрашивать их не нужно
+    Item.objects.bulk_create(batch_create)
+    logs = InventoryLog.objects.bulk_create(
+        InventoryLog.for_part(
+            row.part,
+            row.quantity,
+            operation=InventoryLog.Operation.RECEPTION,
+            comment=comment,
+            invoice=invoice,
+            order_id=extra.get("order_id"),
+        )
+        for row in rows
+    )
+    LogItem = InventoryLog.items.through
+    LogItem.objects.bulk_create(
+        LogItem(inventorylog_id=log.pk, item_id=item.pk)
+        for log, items in zip(logs, log_items)
+        for item in items
+    )
+    update_part_stock(parts)
+    return logs
+
+
+def read_invoice_file(file, name):
+    """
+    Построчно прочитать файл счёта поставщика в формате CSV или XLSX.
+
+    Первая строка - заголовок, дальше колонки: артикул, кол-во, цена.
+    Файл не загружается в память целиком.
+    """
+    if name.lower().endswith(".xlsx"):
+        workbook = load_workbook(file, read_only=True, data_only=True)
+        try:
+            yield from workbook.active.iter_rows(min_row=2, values_only=True)
+        finally:
+            workbook.close()
+        return
+
+    text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+    try:
+        sample = text.read(4096)
+        text.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        reader = csv.reader(text, dialect)
+        next(reader, None)
+        yield from reader
+    finally:
+        # не закрываем исходный файл вместе с обёрткой
+        text.detach()
+
+
+def to_decimal(value):
+    if isinstance(value, (int, float)):
+        return Decimal(str(value))
+    return Decimal(str(value).replace(" ", "").replace(",", "."))
+
+
+def get_invoice_rows(lines):
+    """
+    Собрать строки счёта в строки прихода по моделям комплектующих.
+
+    Артикулы сопоставляются с номенклатурой одним запросом.
+    Возвращает строки прихода и список ненайденных артикулов.
+    """
+    quantities = OrderedCounter()
+    prices = {}
+    for number, line in enumerate(lines, start=2):
+        if not line or line[0] in (None, ""):
+            continue
+        vendor_code = line[0]
+        if isinstance(vendor_code, float) and vendor_code.is_integer():
+            vendor_code = int(vendor_code)
+        vendor_code = str(vendor_code).strip()
+        try:
+            quantities[vendor_code] += int(line[1])
+            if len(line) > 2 and line[2] not in (None, ""):
+                prices[vendor_code] = to_decimal(line[2])
+        except (IndexError, TypeError, ValueError, InvalidOperation):
+            raise ValueError(f"Строка {number}: неверное кол-во или цена")
+
+    parts = Part.objects.in_bulk(list(quantities), field_name="vendor_code")
+    rows = [
+        ReceptionRow(
+            parts[vendor_code],
+            quantity,
+            prices.get(vendor_code, parts[vendor_code].price or Decimal("0.00")),
+            False,
+        )
+        for vendor_code, quantity in quantities.items()
+        if vendor_code in parts
+    ]
+    missing = [vendor_code for vendor_code in quantities if vendor_code not in parts]
+    return rows, missing
+
+
+def import_invoice(file, name, invoice, date=None, comment=""):
+    """
+    Оприходовать комплектующие по файлу счёта поставщика.
+    """
+    rows, missing = get_invoice_rows(read_invoice_file(file, name))
+    if missing:
+        raise ValueError(f"Артикулы не найдены: {', '.join(missing)}")
+    if not rows:
+        raise ValueError("В файле нет комплектующих")
+    return receive_items(rows, date or timezone.now(), comment, invoice=invoice)
 
 
 def wrap_in_color(color, string=None, link=False):
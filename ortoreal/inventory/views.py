@@ -1,11 +1,14 @@
-import io
+import itertools
+import logging
+import os
+import tempfile
 import urllib
-from collections import defaultdict
 from decimal import Decimal
 from typing import Any, Dict
 
 from django.contrib.auth import get_user_model
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
+from django.core.cache import cache
 from django.db import transaction
 from django.db.models import (
     Case,
@@ -13,15 +16,18 @@ from django.db.models import (
     Count,
     F,
     Max,
+    OuterRef,
     Q,
     QuerySet,
+    Subquery,
     Sum,
     Value,
     When,
     Window,
 )
-from django.db.models.functions import Concat, RowNumber
-from django.http.response import HttpResponse
+from django.db.models.functions import Coalesce, Concat, RowNumber
+from django.http import Http404
+from django.http.response import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse
 from django.utils import timezone
@@ -29,16 +35,19 @@ from django.views import View
 
 import django_tables2 as tables
 from django_filters.views import FilterView
+from django_select2.views import AutoResponseView
 from django_tables2.export.views import ExportMixin
 from django_tables2.paginators import LazyPaginator
-from xlsxwriter.workbook import Workbook
 
 from clients.models import Job
+from clients.tables import ItemsColumn
+from core.paginators import KeysetPaginationMixin
 from inventory.filters import InventoryLogFilter, MarginFilter, PartFilter
 from inventory.forms import (
     FreeOrderFormSet,
     InventoryAddForm,
     InventoryTakeForm,
+    InvoiceImportForm,
     InvoiceNumberFormSet,
     ItemReturnFormSet,
     ItemTakeFormSet,
@@ -50,7 +59,15 @@ from inventory.forms import (
     ReceptionForm,
     ReceptionItemFormSet,
 )
-from inventory.models import InventoryLog, Invoice, Item, Order, Part, Prosthesis
+from inventory.models import (
+    InventoryLog,
+    Invoice,
+    Item,
+    Order,
+    Part,
+    Prosthesis,
+    get_current_order_id,
+)
 from inventory.tables import (
     CurrentOrderTable,
     InventoryLogsTable,
@@ -65,19 +82,28 @@ from inventory.tables import (
     VendorExportTable,
     VendorOrdersTable,
 )
-from inventory.utils import (  # TODO; check_minimum_remainder,
-    OrderedCounter,
-    create_reserve,
-    generate_zip,
+from inventory.utils import (
+    close_current_order,
+    get_order_export_key,
+    get_order_export_rows,
+    import_invoice,
+    iter_cached,
+    iter_zip,
+    lock_parts,
     move_reserves_to_free_order,
+    receive_items,
     remove_excess_from_current_order,
-    remove_reserve,
     reorg_reserves,
+    set_job_kit,
+    take_items,
+    update_part_stock,
+    write_xlsx,
 )
 
 PARTS_PER_PAGE = 20
 
 User = get_user_model()
+logger = logging.getLogger(__name__)
 
 
 class LoginRequiredMixin(LoginRequiredMixin):
@@ -106,24 +132,23 @@ class NomenclatureListView(
         return self.request.user.is_manager or self.request.user.is_staff
 
     def get_queryset(self) -> QuerySet[Any]:
+        # остатки берём из сводки, а не пересчитываем записи комплектующих
         queryset = (
-            Part.objects.filter(items__job=None)
+            Part.objects.filter(
+                Q(stock__on_hand__gt=0)
+                | Q(stock__on_order__gt=0)
+                | Q(stock__in_current_order__gt=0)
+            )
             .order_by("vendor_code")
             .annotate(
                 quantity=Concat(
-                    Count("items", filter=Q(items__arrived=True)),
+                    F("stock__on_hand"),
                     Value(" "),
                     "units",
                     output_field=CharField(),
                 ),
-                available=Count(
-                    "items",
-                    filter=Q(items__reserved=None, items__arrived=True),
-                ),
-                in_reserve=Count(
-                    "items",
-                    filter=Q(items__reserved__isnull=False, items__arrived=True),
-                ),
+                available=F("stock__available"),
+                in_reserve=F("stock__reserved"),
             )
         )
         return queryset
@@ -154,6 +179,36 @@ class PartItemsListView(
         return queryset
 
 
+class PartAutocompleteView(LoginRequiredMixin, AutoResponseView):
+    """
+    Поиск моделей комплектующих для выбора в формах.
+    К результатам добавляются поля из data_fields виджета.
+    """
+
+    def get(self, request, *args, **kwargs):
+        self.widget = self.get_widget_or_404()
+        self.term = kwargs.get("term", request.GET.get("term", ""))
+        self.object_list = self.get_queryset()
+        context = self.get_context_data()
+        results = [
+            {
+                "text": self.widget.label_from_instance(obj),
+                "id": obj.pk,
+                **self.widget.get_data(obj),
+            }
+            for obj in context["object_list"]
+        ]
+        return JsonResponse(
+            {"results": results, "more": context["page_obj"].has_next()}
+        )
+
+
+class JobAutocompleteView(LoginRequiredMixin, AutoResponseView):
+    """
+    Поиск работ по фамилии клиента для выбора в формах.
+    """
+
+
 class ReceptionView(LoginRequiredMixin, View):
     """
     Приход.
@@ -168,6 +223,7 @@ class ReceptionView(LoginRequiredMixin, View):
         }
         return render(request, "inventory/reception.html", context)
 
+    @transaction.atomic
     def post(self, request, *args, **kwargs):
         form = ReceptionForm(request.POST)
         formset = ReceptionItemFormSet(request.POST)
@@ -177,73 +233,11 @@ class ReceptionView(LoginRequiredMixin, View):
             return redirect("inventory:reception_invoice", pk=invoice.pk)
 
         if formset.is_valid() and formset.forms:
-            date = form.cleaned_data["date"]
-            operation = InventoryLog.Operation.RECEPTION
-            comment = form.cleaned_data["comment"]
-            # фильтр: не назначен склад, не в текущем заказе и не имеет счёта
-            # сортировка по дате резерва, без резерва - в последнюю очередь
-            ordered_items = Item.objects.filter(
-                arrived=False, order__is_current=False, invoice__isnull=True
-            ).order_by(F("reserved__date").asc(nulls_last=True), F("id").asc())
-
-            batch_update_items = []
-            for fs_form in formset:
-                quantity = fs_form.cleaned_data["quantity"]
-                print(quantity)
-                # Если кол-во не указано или <= 0, то пропустить
-                if quantity is None or quantity <= 0:
-                    continue
-                log = InventoryLog.objects.create(
-                    operation=operation,
-                    comment=comment,
-                )
-                part = fs_form.cleaned_data["part"]
-                price = fs_form.cleaned_data["price"]
-                vendor2 = fs_form.cleaned_data["vendor2"]
-                matching_ordered = ordered_items.filter(part=part)
-                # Проверяем, есть ли пришедшие в заказанных,
-                # добавляем склад и заменяем дату на дату прихода
-                log_items = []
-                if matching_ordered.exists():
-                    match_quantity = len(matching_ordered)
-                    if quantity > match_quantity:
-                        quantity -= match_quantity
-                    else:
-                        match_quantity = quantity
-                        # обнуляем кол-во, чтобы не создавать новые записи
-                        quantity = 0
-                    for item in matching_ordered[:match_quantity]:
-                        item.date = date
-                        item.arrived = True
-                        item.vendor2 = vendor2
-                        batch_update_items.append(item)
-                        log_items.append(item)
-                # Если в приходе больше, чем заказанных,
-                # создаём записи для остальных
-                if quantity:
-                    batch_create_items = [
-                        Item(
-                            part=part,
-                            arrived=True,
-                            vendor2=vendor2,
-                            price=price,
-                            date=date,
-                        )
-                    ] * quantity
-                    Item.objects.bulk_create(batch_create_items)
-                    created_items = Item.objects.filter(
-                        part=part,
-                        arrived=True,
-                        vendor2=vendor2,
-                        price=price,
-                        date=date,
-                    )
-                    log_items += list(created_items)
-
-                # Объединяем созданные и обновляемые записи для лога
-                log.items.set(log_items)
-
-            Item.objects.bulk_update(batch_update_items, ["date", "arrived", "price"])
+            receive_items(
+                formset.get_rows(),
+                form.cleaned_data["date"],
+                form.cleaned_data["comment"],
+            )
 
             return redirect("inventory:logs")
 
@@ -271,6 +265,7 @@ class ReceptionInvoiceView(LoginRequiredMixin, View):
         }
         return render(request, "inventory/reception.html", context)
 
+    @transaction.atomic
     def post(self, request, pk):
         form = ReceptionForm(request.POST)
         formset = ReceptionItemFormSet(request.POST)
@@ -281,78 +276,12 @@ class ReceptionInvoiceView(LoginRequiredMixin, View):
         invoice = form.cleaned_data["invoice"]
 
         if formset.is_valid() and formset.forms:
-            date = form.cleaned_data["date"]
-            operation = InventoryLog.Operation.RECEPTION
-            comment = form.cleaned_data["comment"]
-            # фильтр: не назначен склад, не в текущем заказе и не имеет счёта
-            # сортировка по дате резерва, без резерва - в последнюю очередь
-            ordered_items = invoice.items.filter(
-                arrived=False, order__is_current=False
-            ).order_by(F("reserved__date").asc(nulls_last=True), F("id").asc())
-
-            batch_update_items = []
-            for fs_form in formset:
-                quantity = fs_form.cleaned_data["quantity"]
-                # Если кол-во не указано или <= 0, то пропустить
-                if quantity is None or quantity <= 0:
-                    continue
-                log = InventoryLog.objects.create(
-                    operation=operation,
-                    comment=comment,
-                    invoice=invoice,
-                    order=invoice.order,
-                )
-                part = fs_form.cleaned_data["part"]
-                price = fs_form.cleaned_data["price"]
-                vendor2 = fs_form.cleaned_data["vendor2"]
-                matching_ordered = ordered_items.filter(part=part)
-                # Проверяем, есть ли пришедшие в заказанных,
-                # добавляем склад и заменяем дату на дату прихода
-                log_items = []
-                if matching_ordered.exists():
-                    match_quantity = len(matching_ordered)
-                    if quantity > match_quantity:
-                        quantity -= match_quantity
-                    else:
-                        match_quantity = quantity
-                        # обнуляем кол-во, чтобы не создавать новые записи
-                        quantity = 0
-                    for item in matching_ordered[:match_quantity]:
-                        item.date = date
-                        item.arrived = True
-                        item.vendor2 = vendor2
-                        batch_update_items.append(item)
-                        log_items.append(item)
-                # Если в приходе больше, чем заказанных,
-                # создаём записи для остальных
-                if quantity:
-                    batch_create_items = [
-                        Item(
-                            part=part,
-                            arrived=True,
-                            vendor2=vendor2,
-                            price=price,
-                            date=date,
-                            invoice=invoice,
-                            order=invoice.order,
-                        )
-                    ] * quantity
-                    Item.objects.bulk_create(batch_create_items)
-                    created_items = Item.objects.filter(
-                        part=part,
-                        arrived=True,
-                        vendor2=vendor2,
-                        price=price,
-                        date=date,
-                        invoice=invoice,
-                        order=invoice.order,
-                    )
-                    log_items += list(created_items)
-
-                # Объединяем созданные и обновляемые записи для лога
-                log.items.set(log_items)
-
-            Item.objects.bulk_update(batch_update_items, ["date", "arrived", "price"])
+            receive_items(
+                formset.get_rows(),
+                form.cleaned_data["date"],
+                form.cleaned_data["comment"],
+                invoice=invoice,
+            )
 
             return redirect("inventory:logs")
 
@@ -383,6 +312,36 @@ class ReceptionInvoiceView(LoginRequiredMixin, View):
         return queryset
 
 
+class InvoiceImportView(LoginRequiredMixin, View):
+    """
+    Приход по файлу счёта поставщика.
+    """
+
+    def get(self, request):
+        form = InvoiceImportForm()
+        return render(request, "inventory/invoice_import.html", {"form": form})
+
+    def post(self, request):
+        form = InvoiceImportForm(request.POST, request.FILES)
+
+        if form.is_valid():
+            file = form.cleaned_data["file"]
+            try:
+                import_invoice(
+                    file,
+                    file.name,
+                    form.cleaned_data["invoice"],
+                    form.cleaned_data["date"],
+                    form.cleaned_data["comment"],
+                )
+            except ValueError as e:
+                form.add_error("file", str(e))
+            else:
+                return redirect("inventory:logs")
+
+        return render(request, "inventory/invoice_import.html", {"form": form})
+
+
 class TakeItemsView(LoginRequiredMixin, UserPassesTestMixin, View):
     """
     View расхода комплектующих протезистом.
@@ -396,6 +355,7 @@ class TakeItemsView(LoginRequiredMixin, UserPassesTestMixin, View):
         context = {"form": form, "taking": True}
         return render(request, "inventory/take_return_items.html", context)
 
+    @transaction.atomic
     def post(self, request, *args, **kwargs):
         form = InventoryTakeForm(request.user, request.POST)
         formset = ItemTakeFormSet(request.POST)
@@ -408,76 +368,15 @@ class TakeItemsView(LoginRequiredMixin, UserPassesTestMixin, View):
             if formset.forms:
                 formset = ItemTakeFormSet(request.POST, form_kwargs=form_kwargs)
                 if formset.is_valid():
-                    comment = form.cleaned_data["comment"]
-                    operation = InventoryLog.Operation.TAKE
-                    batch_items = []
-                    # записываем комплектующие, чтобы избавиться от повторов
-                    parts = []
-                    items_filter = (
-                        Q(arrived=True)
-                        & Q(job=None)
-                        & (
-                            Q(reserved=job)
-                            | Q(reserved=None)
-                            | Q(reserved__date__gt=job.date)
-                        )
-                    )
+                    quantities = {}
                     for fs_form in formset:
                         quantity = fs_form.cleaned_data["quantity"]
                         # Если кол-во не указано или <= 0, то пропустить
                         if quantity is None or quantity <= 0:
                             continue
-                        part = fs_form.cleaned_data["part"]
                         # Если модель комплектующего повторилась, то пропустить
-                        if part in parts:
-                            continue
-                        parts.append(part)
-                        # фильтруем: в первую очередь самые старые со склада 2
-                        items = Item.objects.filter(
-                            items_filter & Q(part=part)
-                        ).order_by("-vendor2", "date")[:quantity]
-                        log = InventoryLog(
-                            operation=operation,
-                            job=job,
-                            prosthetist=job.prosthetist,
-                            comment=comment,
-                        )
-                        # сохраняем операцию, чтобы создать
-                        # Many-to-Many связь с комплектующими
-                        log.save()
-                        log = InventoryLog.objects.get(id=log.id)
-                        log.items.set(items)
-                        log.save()
-                        batch_items += list(items)
-                    # упорядоченный словарь моделей комплектующих, в которых
-                    # хранятся работы с кол-вом комплектующих
-                    # для нового резерва
-                    parts_to_reserve = defaultdict(OrderedCounter)
-                    for item in batch_items:
-                        # если комплектующая была взята из чужого резерва,
-                        # то записываем взятый резерв
-                        if item.reserved != job:
-                            # берём словарь модели комплектующей, увеличиваем
-                            # кол-во требуемое в резерв работе, у которой взяли
-                            if item.reserved is not None:
-                                parts_to_reserve[item.part][item.reserved] += 1
-                            item.reserved = job
-                        item.job = job
-
-                    if batch_items:
-                        Item.objects.bulk_update(batch_items, ["job", "reserved"])
-
-                    # пересоздаём резервы для всех, у кого взяли
-                    if parts_to_reserve:
-                        for part, job_dict in parts_to_reserve.items():
-                            print(job_dict)
-                            # берём первую работу и кол-во из словаря
-                            job, quantity = job_dict.popitem(last=False)
-                            create_reserve(part, job, quantity, job_dict=job_dict)
-                    # проверяем неснижаемый остаток
-                    # TODO
-                    # check_minimum_remainder()
-
+                        quantities.setdefault(fs_form.cleaned_data["part"], quantity)
+                    take_items(job, quantities, form.cleaned_data["comment"])
                     return redirect("inventory:nomenclature")
             # если клиент в форме изменился, меняем queryset в формсете
             else:
@@ -487,18 +386,23 @@ class TakeItemsView(LoginRequiredMixin, UserPassesTestMixin, View):
         return render(request, "inventory/take_return_items.html", context)
 
     def get_queryset(self, job):
-        # разрешить брать из чужих резервов, если они новее
-        qs_filter = (
-            Q(items__arrived=True)
-            & Q(items__job=None)
-            & (
-                Q(items__reserved=job)
-                | Q(items__reserved=None)
-                | Q(items__reserved__date__gt=job.date)
+        # к свободным на складе добавляем свои резервы
+        # и чужие резервы, если они новее
+        reserves = (
+            Item.objects.filter(
+                Q(reserved=job) | Q(reserved__date__gt=job.date),
+                part=OuterRef("pk"),
+                arrived=True,
+                job=None,
             )
+            .order_by()
+            .values("part")
+            .annotate(count=Count("id"))
+            .values("count")
         )
         queryset = Part.objects.annotate(
-            available=Count("items", filter=qs_filter),
+            available=Coalesce(F("stock__available"), 0)
+            + Coalesce(Subquery(reserves), 0),
         ).order_by("vendor_code")
         return queryset
 
@@ -517,6 +421,7 @@ class ReturnItemsView(LoginRequiredMixin, UserPassesTestMixin, View):
         context = {"form": form, "taking": False, "formset": formset}
         return render(request, "inventory/take_return_items.html", context)
 
+    @transaction.atomic
     def post(self, request, *args, **kwargs):
         form = InventoryTakeForm(request.user, request.POST)
         formset = ItemReturnFormSet(request.POST, prefix="item")
@@ -540,50 +445,69 @@ class ReturnItemsView(LoginRequiredMixin, UserPassesTestMixin, View):
                 job_items = job.items.order_by("vendor2", "-date", "-id")
                 comment = form.cleaned_data["comment"]
                 operation = InventoryLog.Operation.RETURN
-                # сюда записываем какие модели комплектующих были возвращены
-                parts = []
-                batch_logs = []
-                # партия возвращаемых на массовое обновление
-                batch_items = []
-                # партия резервов на массовое обновление
-                batch_reserved = []
+                # возвращаемое кол-во по моделям комплектующих
+                quantities = {}
                 for fs_form in formset:
                     quantity = fs_form.cleaned_data["quantity"]
                     # Если кол-во не указано или <= 0, то пропустить
                     if quantity is None or quantity <= 0:
                         continue
-                    part_id = fs_form.cleaned_data["part_id"]
-                    part = get_object_or_404(Part, id=part_id)
-                    parts.append((part, quantity))
+                    quantities.setdefault(fs_form.cleaned_data["part_id"], quantity)
+                # блокируем модели до конца возврата
+                lock_parts(quantities)
+                parts = Part.objects.in_bulk(quantities)
+                batch_logs = []
+                # возвращаемые комплектующие по записям лога
+                log_items = []
+                for part_id, quantity in quantities.items():
+                    part = parts.get(part_id)
+                    if part is None:
+                        raise Http404
                     # срезаем кол-во которое нужно вернуть
-                    items = job_items.filter(part=part)[:quantity]
-                    log = InventoryLog(
-                        operation=operation,
-                        job=job,
-                        prosthetist=request.user,
-                        comment=comment,
+                    items = list(job_items.filter(part=part)[:quantity])
+                    batch_logs.append(
+                        InventoryLog.for_part(
+                            part,
+                            len(items),
+                            operation=operation,
+                            job=job,
+                            prosthetist=request.user,
+                            comment=comment,
+                        )
                     )
-                    log.save()
-                    log = InventoryLog.objects.get(id=log.id)
-                    log.items.set(items)
-                    log.save()
-                    batch_items += list(items)
-                    batch_logs.append(log)
+                    log_items.append(items)
 
+                batch_items = list(itertools.chain.from_iterable(log_items))
                 for item in batch_items:
                     item.job = None
                     item.reserved = None
                 # сохраняем обновления
                 if batch_items:
                     Item.objects.bulk_update(batch_items, ["job", "reserved"])
-                if batch_reserved:
-                    Item.objects.bulk_update(batch_reserved, ["reserved"])
+                logs = InventoryLog.objects.bulk_create(batch_logs)
+                LogItem = InventoryLog.items.through
+                LogItem.objects.bulk_create(
+                    LogItem(inventorylog_id=log.pk, item_id=item.pk)
+                    for log, items in zip(logs, log_items)
+                    for item in items
+                )
                 # пересчитываем резервы для возвращённых моделей комплектующих
-                for part, quantity in parts:
-                    reorg_reserves(part)
+                rows = 0
+                jobs = set()
+                for part in parts.values():
+                    changes = reorg_reserves(part)
+                    rows += changes.rows
+                    jobs |= changes.jobs
+                logger.info(
+                    "Возврат по работе %s: изменено резервов %d, затронуты работы %s",
+                    job.pk,
+                    rows,
+                    sorted(jobs),
+                )
 
                 # удаляем возможные излишки из текущего заказа после пересчёта
-                remove_excess_from_current_order()
+                remove_excess_from_current_order(parts)
+                update_part_stock(parts)
 
                 return redirect("inventory:logs")
 
@@ -617,6 +541,7 @@ class PickPartsView(LoginRequiredMixin, UserPassesTestMixin, View):
         context = {"forms": [client_form]}
         return render(request, "inventory/pick_parts.html", context)
 
+    @transaction.atomic
     def post(self, request, *args, **kwargs):
         client_form = JobSelectForm(user=request.user, data=request.POST)
         job_pk = kwargs.get("job", None)
@@ -635,42 +560,17 @@ class PickPartsView(LoginRequiredMixin, UserPassesTestMixin, View):
                 formset = PickPartsFormSet(initial=queryset.values("part", "quantity"))
             # иначе, проверяем валидность формы протеза и формсета
             elif prosthesis_form.is_valid() and formset.is_valid():
-                # записываем модели комплектующих в текущем резерве
-                initial_parts = dict(queryset.values_list("id", "quantity"))
-                parts = []
+                # записываем комплект целиком, повторы моделей пропускаем
+                kit = {}
                 for fs_form in formset:
-                    part = fs_form.cleaned_data["part"]
-                    if part.id in parts:
-                        continue
-                    parts.append(part.id)
-                    quantity = fs_form.cleaned_data["quantity"]
-                    if part.id in initial_parts:
-                        old_quantity = initial_parts[part.id]
-                        # если указанное кол-во больше исходного,
-                        # то выделяем резерв
-                        if quantity > old_quantity:
-                            create_reserve(part, job, quantity - old_quantity)
-                        # если меньше, возвращаем и пересчитываем резервы
-                        elif quantity < old_quantity:
-                            # удалить резервы
-                            remove_reserve(part, job, old_quantity - quantity)
-                            # пересчитать резервы,
-                            reorg_reserves(part, job)
-                    elif quantity:
-                        create_reserve(part, job, quantity)
-                # проверяем удалённые строки
-                for part_id, quantity in initial_parts.items():
-                    if part_id not in parts:
-                        part = Part.objects.get(id=part_id)
-                        remove_reserve(part, job, quantity)
-                        reorg_reserves(part, job)
+                    part = fs_form.cleaned_data.get("part")
+                    if part is not None:
+                        kit.setdefault(part.id, fs_form.cleaned_data["quantity"])
+                set_job_kit(job, kit)
 
                 prosthesis = prosthesis_form.cleaned_data["prosthesis"]
                 job.prosthesis = prosthesis
                 job.save()
-                # TODO
-                # check_minimum_remainder()
-
                 return redirect("inventory:job_sets")
 
         context = {
@@ -704,6 +604,7 @@ class PickPartsView(LoginRequiredMixin, UserPassesTestMixin, View):
         context = {"forms": [client_form]}
         return render(request, "inventory/pick_parts.html", context)
 
+    @transaction.atomic
     def post(self, request, *args, **kwargs):
         client_form = JobSelectForm(user=request.user, data=request.POST)
         job_pk = kwargs.get("job", None)
@@ -722,42 +623,17 @@ class PickPartsView(LoginRequiredMixin, UserPassesTestMixin, View):
                 formset = PickPartsFormSet(initial=queryset.values("part", "quantity"))
             # иначе, проверяем валидность формы протеза и формсета
             elif prosthesis_form.is_valid() and formset.is_valid():
-                # записываем модели комплектующих в текущем резерве
-                initial_parts = dict(queryset.values_list("id", "quantity"))
-                parts = []
+                # записываем комплект целиком, повторы моделей пропускаем
+                kit = {}
                 for fs_form in formset:
-                    part = fs_form.cleaned_data["part"]
-                    if part.id in parts:
-                        continue
-                    parts.append(part.id)
-                    quantity = fs_form.cleaned_data["quantity"]
-                    if part.id in initial_parts:
-                        old_quantity = initial_parts[part.id]
-                        # если указанное кол-во больше исходного,
-                        # то выделяем резерв
-                        if quantity > old_quantity:
-                            create_reserve(part, job, quantity - old_quantity)
-                        # если меньше, возвращаем и пересчитываем резервы
-                        elif quantity < old_quantity:
-                            # удалить резервы
-                            remove_reserve(part, job, old_quantity - quantity)
-                            # пересчитать резервы,
-                            reorg_reserves(part, job)
-                    elif quantity:
-                        create_reserve(part, job, quantity)
-                # проверяем удалённые строки
-                for part_id, quantity in initial_parts.items():
-                    if part_id not in parts:
-                        part = Part.objects.get(id=part_id)
-                        remove_reserve(part, job, quantity)
-                        reorg_reserves(part, job)
+                    part = fs_form.cleaned_data.get("part")
+                    if part is not None:
+                        kit.setdefault(part.id, fs_form.cleaned_data["quantity"])
+                set_job_kit(job, kit)
 
                 prosthesis = prosthesis_form.cleaned_data["prosthesis"]
                 job.prosthesis = prosthesis
                 job.save()
-                # TODO
-                # check_minimum_remainder()
-
                 return redirect("inventory:job_sets")
 
         context = {
@@ -791,24 +667,30 @@ class FreeOrderAddView(LoginRequiredMixin, UserPassesTestMixin, View):
         context = {"formset": formset}
         return render(request, "inventory/free_order.html", context)
 
+    @transaction.atomic
     def post(self, request, *args, **kwargs):
         formset = FreeOrderFormSet(request.POST)
         if formset.forms and formset.is_valid():
             # order = get_object_or_404(Order, is_current=True)
+            # Если кол-во не указано или <= 0, то пропустить
+            rows = [
+                (fs_form.cleaned_data["part"], fs_form.cleaned_data["quantity"])
+                for fs_form in formset
+                if (fs_form.cleaned_data["quantity"] or 0) > 0
+            ]
+            # максимальная цена всех выбранных моделей одним запросом
+            prices = dict(
+                Item.objects.filter(part__in=[part for part, _ in rows])
+                .values("part")
+                .annotate(max_price=Max("price"))
+                .values_list("part", "max_price")
+                .order_by()
+            )
             batch_create = []
-            for fs_form in formset:
-                quantity = fs_form.cleaned_data["quantity"]
-                # Если кол-во не указано или <= 0, то пропустить
-                if quantity is None or quantity <= 0:
-                    continue
-                part = fs_form.cleaned_data["part"]
-                print(part)
-                price = part.items.aggregate(Max("price")).get(
-                    "price__max", Decimal("0.00")
-                )
+            for part, quantity in rows:
+                price = prices.get(part.pk)
                 if price is None:
                     price = Decimal("0.00")
-                print(price)
                 batch_create += [
                     Item(
                         part=part,
@@ -818,10 +700,13 @@ class FreeOrderAddView(LoginRequiredMixin, UserPassesTestMixin, View):
                     )
                 ] * quantity
 
+            # резервы и излишки меняются только у добавленных моделей
+            parts = {item.part_id for item in batch_create}
+            lock_parts(parts)
             Item.objects.bulk_create(batch_create)
-
-            print(move_reserves_to_free_order())
-            print(remove_excess_from_current_order())
+            move_reserves_to_free_order(parts)
+            remove_excess_from_current_order(parts)
+            update_part_stock(parts)
 
             return redirect("inventory:order")
 
@@ -842,10 +727,11 @@ class FreeOrderEditView(LoginRequiredMixin, UserPassesTestMixin, View):
         context = {"formset": formset, "editing": True}
         return render(request, "inventory/free_order.html", context)
 
+    @transaction.atomic
     def post(self, request, *args, **kwargs):
         formset = FreeOrderFormSet(request.POST)
         if formset.is_valid():
-            initial = dict(
+            initial_quantities = (
                 Part.objects.annotate(
                     quantity=Count(
                         "items",
@@ -856,6 +742,13 @@ class FreeOrderEditView(LoginRequiredMixin, UserPassesTestMixin, View):
                 .exclude(quantity=0)
                 .values_list("id", "quantity")
             )
+            initial = dict(initial_quantities)
+            # блокируем модели и перечитываем свободный заказ,
+            # т.к. до блокировки его могли изменить
+            lock_parts(
+                set(initial) | {form.cleaned_data["part"].pk for form in formset}
+            )
+            initial = dict(initial_quantities.all())
             # записываем модели комплектующих, которые были проверены
             parts = []
             batch_create = []
@@ -897,10 +790,9 @@ class FreeOrderEditView(LoginRequiredMixin, UserPassesTestMixin, View):
             # создаём записи комплектующих и перемещаем на них обычные заказы
             if batch_create:
                 Item.objects.bulk_create(batch_create)
-                move_reserves_to_free_order()
+                move_reserves_to_free_order({item.part_id for item in batch_create})
+            update_part_stock(set(parts) | set(initial))
 
-            # TODO
-            # check_minimum_remainder()
             return redirect("inventory:order")
 
         context = {"formset": formset, "editing": True}
@@ -1003,32 +895,16 @@ class OrderView(
         return True
 
     def get_order(self):
-        if self.is_current:
-            return Order.get_current()
-        pk = self.kwargs.get("pk")
-        return get_object_or_404(Order, pk=pk)
-
-    # TODO
-    # def get(self, request, pk=None):
-    #    check_minimum_remainder()
-    #    return super().get(request)
+        if not hasattr(self, "_order"):
+            if self.is_current:
+                self._order = Order.get_current()
+            else:
+                self._order = get_object_or_404(Order, pk=self.kwargs.get("pk"))
+        return self._order
 
     def post(self, request, pk=None):
-        current_order = Order.get_current()
-
         if self.is_current:
-            vendor_items = defaultdict(list)
-
-            for item in current_order.items.all():
-                vendor_items[item.part.vendor].append(item)
-
-            with transaction.atomic():
-                for vendor, items in vendor_items.items():
-                    order = Order.objects.create(vendor=vendor)
-                    for item in items:
-                        item.order = order
-                    Item.objects.bulk_update(items, ["order"])
-
+            close_current_order()
             return redirect("inventory:orders")
 
         # order = self.get_order()
@@ -1077,7 +953,7 @@ class OrderView(
         else:
             context["title"] = "Заказ от"
         context["order"] = order
-        context["formset"] = InvoiceNumberFormSet(initial=self.get_queryset())
+        context["formset"] = InvoiceNumberFormSet(initial=self.object_list)
         return context
 
 
@@ -1099,8 +975,11 @@ class OrderCancelView(LoginRequiredMixin, UserPassesTestMixin, View):
 
         current_order = Order.get_current()
         with transaction.atomic():
+            part_ids = set(order.items.values_list("part_id", flat=True))
+            lock_parts(part_ids)
             Item.objects.filter(order=order).update(order=current_order)
             order.delete()
+            update_part_stock(part_ids)
         return redirect("inventory:orders")
 
 
@@ -1108,6 +987,7 @@ class OrdersView(
     LoginRequiredMixin,
     UserPassesTestMixin,
     ExportMixin,
+    KeysetPaginationMixin,
     tables.SingleTableView,
 ):
     """
@@ -1115,7 +995,6 @@ class OrdersView(
     """
 
     table_class = OrdersTable
-    paginator_class = LazyPaginator
     paginate_by = PARTS_PER_PAGE
 
     def test_func(self) -> bool:
@@ -1152,6 +1031,13 @@ class VendorOrdersView(
     def get(self, request):
         orders_qs = self.get_queryset()
         orders_table = VendorOrdersTable(orders_qs)
+        tables.RequestConfig(
+            request,
+            paginate={
+                "paginator_class": self.paginator_class,
+                "per_page": self.paginate_by,
+            },
+        ).configure(orders_table)
         context = {
             "orders_table": orders_table,
         }
@@ -1163,74 +1049,71 @@ def export_orders(request, pk=None):
     """
     Экспорт заказов по поставщикам в .zip архиве.
     """
-    if pk is not None:
-        order = get_object_or_404(Order, pk=pk)
+    order_id = pk if pk is not None else get_current_order_id()
+    # строки заказа читаются одним запросом при каждом скачивании, по ним же
+    # считается ключ кэша, повторно архив не собирается
+    rows = get_order_export_rows(order_id)
+    cache_key = get_order_export_key(order_id, rows)
+    archive = cache.get(cache_key)
+    if archive is not None:
+        response = HttpResponse(archive)
     else:
-        order = get_object_or_404(Order, is_current=True)
-    vendors = (
-        order.items.annotate(
-            vendor_id=F("part__vendor__id"),
-            name=Case(
-                When(part__vendor__isnull=True, then=Value("-")),
-                default=F("part__vendor__name"),
-            ),
-        )
-        .values("vendor_id", "name")
-        .distinct()
-    )
-    order_table = (
-        order.items.values("part")
-        .annotate(
-            row=Window(RowNumber()),
-            vendor_code=F("part__vendor_code"),
-            # price=F("part__price"),
-            quantity=Count("part"),
-            # price_mul=F("quantity") * F("price"),
+        get_object_or_404(Order, pk=order_id)
+        response = StreamingHttpResponse(
+            iter_cached(iter_zip(iter_order_files(rows)), cache_key)
         )
-        .order_by("vendor_code")
-    )
-    files = []
-    for vendor in vendors:
-        vendor_queryset = order_table.filter(part__vendor_id=vendor["vendor_id"])
-        table = VendorExportTable(vendor_queryset)
-        output = io.BytesIO()
-        workbook = Workbook(output, {"in_memory": True})
-        worksheet = workbook.add_worksheet()
-        for i, row in enumerate(table.as_values()):
-            for j, value in enumerate(row):
-                worksheet.write(i, j, value)
-        worksheet.autofit()
-        workbook.close()
-        table_file = output.getvalue()
-        output.close()
-        files.append((vendor["name"] + ".xlsx", table_file))
 
     current_date = timezone.now().strftime("%Y-%m-%d_%H-%M")
     zip_name = urllib.parse.quote(f"Заказ_от_{current_date}")
-    response = HttpResponse(generate_zip(files))
     response["Content-Type"] = "application/x-zip-compressed"
     response["Content-Disposition"] = f"attachment; filename*=UTF-8''{zip_name}.zip"
 
     return response
 
 
-class InventoryLogListView(LoginRequiredMixin, tables.SingleTableMixin, FilterView):
+def iter_order_files(rows):
+    """
+    Файлы .xlsx заказа по поставщикам из строк get_order_export_rows,
+    по одному за раз.
+    """
+    header = [str(column.header) for column in VendorExportTable([]).columns]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for (vendor_id, vendor), vendor_rows in itertools.groupby(
+            rows, key=lambda row: row[:2]
+        ):
+            path = os.path.join(tmp_dir, f"{vendor_id}.xlsx")
+            write_xlsx(
+                path,
+                itertools.chain(
+                    [header],
+                    (
+                        [i, vendor_code, quantity]
+                        for i, (_, _, vendor_code, quantity) in enumerate(
+                            vendor_rows, start=1
+                        )
+                    ),
+                ),
+            )
+            yield f"{vendor}.xlsx", path
+            os.remove(path)
+
+
+class InventoryLogListView(
+    LoginRequiredMixin, KeysetPaginationMixin, tables.SingleTableMixin, FilterView
+):
     """
     View логов инвентаря.
     """
 
     table_class = InventoryLogsTable
-    paginator_class = LazyPaginator
     paginate_by = 30
     template_name = "inventory/inventorylog.html"
 
     filterset_class = InventoryLogFilter
 
     def get_queryset(self) -> QuerySet[Any]:
-        queryset = InventoryLog.objects.annotate(
-            item_count=Count("items"),
-            vendor_code=F("items__part__vendor_code"),
-            part_name=F("items__part__name"),
+        queryset = InventoryLog.objects.select_related(
+            "job__client", "job__prosthesis", "prosthetist"
         ).order_by("-date")
         return queryset
 
@@ -1266,40 +1149,20 @@ class JobSetView(LoginRequiredMixin, UserPassesTestMixin, View):
         context = {"form": form, "formset": formset}
         return render(request, "inventory/job_set.html", context)
 
+    @transaction.atomic
     def post(self, request, pk):
         job = get_object_or_404(Job, pk=pk)
         queryset = self.get_queryset(job)
         form = ProsthesisSelectForm(job=job)
         formset = PickPartsFormSet(request.POST or queryset.values("part", "quantity"))
         if formset.is_valid():
-            initial_parts = dict(queryset.values_list("id", "quantity"))
-            parts = []
+            # записываем комплект целиком, повторы моделей пропускаем
+            kit = {}
             for fs_form in formset:
-                part = fs_form.cleaned_data["part"]
-                if part.id in parts:
-                    continue
-                parts.append(part.id)
-                quantity = fs_form.cleaned_data["quantity"]
-                if part.id in initial_parts:
-                    old_quantity = initial_parts[part.id]
-                    # если указанное кол-во больше исходного,
-                    # то выделяем резерв
-                    if quantity > old_quantity:
-                        create_reserve(part, job, quantity - old_quantity)
-                    # если меньше, возвращаем и пересчитываем резервы
-                    elif quantity < old_quantity:
-                        # удалить резервы
-                        remove_reserve(part, job, old_quantity - quantity)
-                        # пересчитать резервы,
-                        reorg_reserves(part, job)
-                elif quantity:
-                    create_reserve(part, job, quantity)
-            # проверяем удалённые строки
-            for part_id, quantity in initial_parts.items():
-                if part_id not in parts:
-                    part = Part.objects.get(id=part_id)
-                    remove_reserve(part, job, quantity)
-                    reorg_reserves(part, job)
+                part = fs_form.cleaned_data.get("part")
+                if part is not None:
+                    kit.setdefault(part.id, fs_form.cleaned_data["quantity"])
+            set_job_kit(job, kit)
 
             return redirect("clients:client", pk=job.client.pk)
 
@@ -1318,20 +1181,29 @@ class JobSetView(LoginRequiredMixin, UserPassesTestMixin, View):
         return queryset
 
 
-class JobSetsView(LoginRequiredMixin, UserPassesTestMixin, tables.SingleTableView):
+class JobSetsView(
+    LoginRequiredMixin,
+    UserPassesTestMixin,
+    KeysetPaginationMixin,
+    tables.SingleTableView,
+):
     """
     View комплектов клиентов протезиста.
     """
 
     table_class = JobSetsTable
-    paginator_class = LazyPaginator
     paginate_by = PARTS_PER_PAGE
 
     def test_func(self) -> bool:
         return self.request.user.is_prosthetist
 
     def get_queryset(self) -> QuerySet[Any]:
-        queryset = Job.objects.filter(prosthetist=self.request.user).order_by("-date")
+        queryset = (
+            Job.objects.filter(prosthetist=self.request.user)
+            .select_related("client", "prosthetist", "prosthesis")
+            .prefetch_related(ItemsColumn.get_prefetch())
+            .order_by("-date")
+        )
         return queryset
 
     def get_context_data(self, **kwargs: Any) -> Dict[str, Any]:
@@ -1350,7 +1222,11 @@ class AllJobSetsView(JobSetsView):
         return self.request.user.is_manager
 
     def get_queryset(self) -> QuerySet[Any]:
-        queryset = Job.objects.order_by("-date")
+        queryset = (
+            Job.objects.select_related("client", "prosthetist", "prosthesis")
+            .prefetch_related(ItemsColumn.get_prefetch())
+            .order_by("-date")
+        )
         return queryset
 
     def get_context_data(self, **kwargs: Any) -> Dict[str, Any]:
@@ -1379,7 +1255,9 @@ class MarginView(
         return self.request.user.is_manager
 
     def get_queryset(self) -> QuerySet[Any]:
-        queryset = Job.objects.annotate(
+        queryset = Job.objects.select_related(
+            "client", "prosthetist", "prosthesis"
+        ).annotate(
             price_items=Sum("items__price"),
             price=Case(
                 When(prosthesis__price__isnull=True, then=Decimal("0.00")),
@@ -5,6 +5,7 @@ from decimal import Decimal
 from django.utils.timezone import make_aware
 
 from inventory.models import Item, Part, Vendor
+from inventory.utils import update_part_stock
 
 NUMBER_CHARS = "0123456789-,."
 
@@ -55,3 +56,4 @@ def run():
             ] * quantity
 
         Item.objects.bulk_create(batch_create)
+        update_part_stock()
@@ -1,6 +1,7 @@
 import csv
 
 from inventory.models import Item, Part
+from inventory.utils import update_part_stock
 
 
 def run():
@@ -20,3 +21,4 @@ def run():
             batch_create += [Item(part=part, arrived=True)] * quantity
 
         Item.objects.bulk_create(batch_create)
+        update_part_stock()
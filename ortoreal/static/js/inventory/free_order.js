@@ -28,14 +28,22 @@ function cleanForm(form) {
   form.querySelector('[name$="-quantity"]').value = "0";
 }
 
+/* данные выбранной модели: из ответа поиска или из data-атрибутов */
+function partData(select, field) {
+  let data = $(select).select2("data")[0];
+  if (!data || !data.id) {
+    return undefined;
+  }
+  return data[field] ?? $(data.element).data(field);
+}
+
 function changeMinimumRemainder() {
-  let index = $(this).prop("selectedIndex");
-  let minimum_remainder = $(this)
+  $(this)
     .closest(".input-row")
     .children("td")
     .has('[id$="-minimum_remainder"]')
-    .find("select");
-  minimum_remainder.prop("selectedIndex", index);
+    .find("input")
+    .val(partData(this, "minimum_remainder") ?? "");
 }
 
 if (formNum) {
@@ -46,10 +54,9 @@ if (formNum) {
 if (formNum == 1) {
   $("#remove-form").hide();
 }
-$('[id$="-part"').each(function () {
-  $(this).select2();
+$(document).ready(function () {
+  $('[id$="-part"]').each(changeMinimumRemainder);
 });
-$('[id$="-part"').each(changeMinimumRemainder);
 /////////////////
 
 function removeLastEmpty() {
@@ -76,7 +83,7 @@ function addForm(e) {
   form.innerHTML = form.innerHTML.replace(formRegex, `form-${formNum}-`);
   document.querySelector("#form-container tbody").append(form);
   cleanForm(form);
-  $(`[name="form-${formNum}-part"]`).select2();
+  $(`[name="form-${formNum}-part"]`).djangoSelect2();
   formNum++;
   totalForms.setAttribute("value", `${formNum}`);
   $("#remove-form").show();
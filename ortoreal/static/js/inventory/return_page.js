@@ -6,14 +6,6 @@ let fullForm = document.querySelector("#form-container");
 var form = document.querySelectorAll(".input-row");
 var formNum = form.length;
 
-$(document).ready(function () {
-  $("#id_job").each(function () {
-    $(this).select2({
-      theme: "bootstrap-5",
-    });
-  });
-});
-
 function clearFormSet(e) {
   if (totalForms) {
     totalForms.setAttribute("value", "0");
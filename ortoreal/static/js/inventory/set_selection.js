@@ -1,4 +1,9 @@
 let totalForms = document.querySelector("#id_form-TOTAL_FORMS");
+/* копируем строку до того, как django-select2 оформит выбор */
+let emptyForm = document.querySelector(".input-row");
+if (emptyForm) {
+  emptyForm = emptyForm.cloneNode(true);
+}
 function clearFormSet(e) {
   if (totalForms) {
     totalForms.setAttribute("value", "0");
@@ -33,16 +38,13 @@ $(document).ready(function () {
   }
 
   if (formNum) {
-    var firstForm = forms[0].cloneNode(true);
+    var firstForm = emptyForm;
   }
 
   ///////////////
   if (formNum == 1) {
     $("#remove-form").hide();
   }
-  $('[id$="-part"').each(function () {
-    $(this).select2();
-  });
   /////////////////
 
   function removeLastEmpty() {
@@ -69,7 +71,7 @@ $(document).ready(function () {
     form.innerHTML = form.innerHTML.replace(formRegex, `form-${formNum}-`);
     document.querySelector("#form-container tbody").append(form);
     cleanForm(form);
-    $(`[name="form-${formNum}-part"]`).select2();
+    $(`[name="form-${formNum}-part"]`).djangoSelect2();
     formNum++;
     totalForms.setAttribute("value", `${formNum}`);
     $("#remove-form").show();
@@ -1,4 +1,9 @@
 var totalForms = document.querySelector("#id_form-TOTAL_FORMS");
+/* копируем строку до того, как django-select2 оформит выбор */
+var emptyForm = document.querySelector(".input-row");
+if (emptyForm) {
+  emptyForm = emptyForm.cloneNode(true);
+}
 function clearFormSet() {
   if (totalForms) {
     totalForms.setAttribute("value", "0");
@@ -15,15 +20,23 @@ $(document).ready(function () {
   var forms = document.querySelectorAll(".input-row");
   var formNum = forms.length;
 
+  /* данные выбранной модели: из ответа поиска или из data-атрибутов */
+  function partData(select, field) {
+    let data = $(select).select2("data")[0];
+    if (!data || !data.id) {
+      return undefined;
+    }
+    return data[field] ?? $(data.element).data(field);
+  }
+
   function changeAvailable() {
-    let index = $(this).prop("selectedIndex");
-    let select = $(this)
+    let value = partData(this, "available") ?? "-";
+    $(this)
       .closest(".input-row")
       .children("td")
-      .has('[id$="-total"]')
-      .find("select");
-    select.prop("selectedIndex", index);
-    let value = select.find("option:selected").text();
+      .has('[id$="-available"]')
+      .find("input")
+      .val(value);
     let input = $(this)
       .closest(".input-row")
       .children("td")
@@ -52,20 +65,12 @@ $(document).ready(function () {
   }
 
   if (formNum) {
-    var firstForm = forms[0].cloneNode(true);
+    var firstForm = emptyForm;
   }
 
   if (formNum == 1) {
     $("#remove-form").hide();
   }
-  $("#id_job").each(function () {
-    $(this).select2({
-      theme: "bootstrap-5",
-    });
-  });
-  $('[id$="-part"').each(function () {
-    $(this).select2();
-  });
   $('[id$="-part"]').each(changeAvailable);
 
   function removeLastEmpty() {
@@ -92,7 +97,7 @@ $(document).ready(function () {
     form.innerHTML = form.innerHTML.replace(formRegex, `form-${formNum}-`);
     document.querySelector("#form-container tbody").append(form);
     cleanForm(form);
-    $(`[name="form-${formNum}-part"]`).select2();
+    $(`[name="form-${formNum}-part"]`).djangoSelect2();
     formNum++;
     totalForms.setAttribute("value", `${formNum}`);
     $("#remove-form").show();